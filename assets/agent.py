@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+    Node-local approval agent.
+    The waiting gets and puts of a node can delegate their waits to the agent instead of each reading its own lock.
+    The agent reads each watched pool once per tick, whatever the number of waiters, and wakes up the waiters
+    whose lock changed. A waiter then reads its lock itself, so the agent is never trusted with the lock state.
+
+        python3 assets/agent.py --listen /var/run/concourse-approval.sock --region eu-west-1
+
+    The storage is configured when the agent starts, with the credentials of its environment: the waiters never
+    send credentials, and can't make the agent read another storage.
+    The agent is reached over a Unix socket, or over TCP with a host:port address on the loopback interface only.
+    The protocol is a JSON line per request and per response: the request holds the pool, lock name, last revision
+    read by the waiter and timeout, the response tells whether the lock changed before the timeout.
+"""
+
+import argparse
+import ipaddress
+import json
+import logging as log
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from storage import get_storage, lock_id
+
+# The fields of a wait request, the requests with other fields are refused
+REQUEST_FIELDS = ('pool', 'lockname', 'revision', 'timeout')
+
+
+def tcp_address(address):
+    """
+    Parse the address of an agent
+    :return: (host, port) for a host:port address, None for the path of a Unix socket
+    """
+    if '/' in address or ':' not in address:
+        return None
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def is_loopback(host):
+    """ Whether a host name or address resolves to the loopback interface """
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def connect(address, timeout):
+    """
+    Open a connection to an agent
+    :param address: the path of a Unix socket, or host:port
+    :return: the connected socket
+    """
+    if tcp_address(address):
+        return socket.create_connection(tcp_address(address), timeout=timeout)
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    try:
+        connection.connect(address)
+    except OSError:
+        connection.close()
+        raise
+    return connection
+
+
+class Waiter:
+    """
+        A lock waited on, until its revision is newer than the last one read by the waiter
+    """
+
+    def __init__(self, id, revision):
+        self.id = id
+        self.revision = revision
+        self.changed = False
+        self.event = threading.Event()
+
+
+class PoolWatch:
+    """
+        The waiters of a pool, served by a single read of the pool per tick.
+        The marker of the pool is read first, the locks are only queried when it moved.
+    """
+
+    def __init__(self, storage, pool):
+        self.storage = storage
+        self.pool = pool
+        self.waiters = []
+        # Revision of the locks of the pool, by id, and revision of the marker when they were read
+        self.revisions = None
+        self.marker_revision = None
+
+    def poll(self):
+        marker = self.storage.get_pool_marker(self.pool)
+        if self.revisions is None or marker is None or marker.revision != self.marker_revision:
+            self.revisions = dict((lock.id, lock.revision) for lock in self.storage.query_pool(self.pool))
+            self.marker_revision = marker.revision if marker else None
+        for waiter in list(self.waiters):
+            revision = self.revisions.get(waiter.id)
+            # The view of the agent can be older than the revision read by the waiter
+            if revision is None and waiter.revision is None:
+                continue
+            if revision is None or waiter.revision is None or revision > waiter.revision:
+                waiter.changed = True
+                waiter.event.set()
+
+
+class Agent:
+    """
+        Coalesce the reads of the waiters of a node, per pool of its storage
+    """
+
+    def __init__(self, storage, interval=2):
+        self.storage = storage
+        self.interval = interval
+        self.watches = {}
+        self.lock = threading.Lock()
+
+    def wait(self, pool, lockname, revision, timeout):
+        """
+        Block until the revision of a lock is newer than the given one, or the timeout expires
+        :param revision: the last revision read by the waiter, None if the lock did not exist
+        :return: True if the lock changed
+        """
+        waiter = Waiter(lock_id(pool, lockname), revision)
+        with self.lock:
+            watch = self.watches.setdefault(pool, PoolWatch(self.storage, pool))
+            watch.waiters.append(waiter)
+        try:
+            waiter.event.wait(timeout)
+        finally:
+            with self.lock:
+                watch.waiters.remove(waiter)
+        return waiter.changed
+
+    def run(self):
+        """ Read the watched pools every interval """
+        while True:
+            start = time.time()
+            with self.lock:
+                for key in [key for key, watch in self.watches.items() if not watch.waiters]:
+                    del self.watches[key]
+                watches = list(self.watches.values())
+            for watch in watches:
+                try:
+                    watch.poll()
+                except Exception as error:
+                    log.warning('Unable to read the pool %s: %s' % (watch.pool, error))
+            time.sleep(max(0, self.interval - (time.time() - start)))
+
+
+class AgentRequestHandler(socketserver.StreamRequestHandler):
+    """
+        Serve a wait request of a waiter
+    """
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode())
+            unknown = set(request) - set(REQUEST_FIELDS)
+            if unknown:
+                raise ValueError('Unknown fields %s' % ', '.join(sorted(unknown)))
+            changed = self.server.agent.wait(str(request['pool']), str(request['lockname']),
+                                             request.get('revision'), float(request['timeout']))
+            response = {'changed': changed}
+        except Exception as error:
+            log.warning('Invalid request: %s' % error)
+            response = {'error': str(error)}
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+class AgentWaiter:
+    """
+        Sleep function of a Poller waking up when the agent sees a change of the lock.
+        If the agent can't be reached, it is dropped and the waiter falls back to polling every fallback seconds.
+    """
+
+    def __init__(self, address, pool, lockname, revision, fallback):
+        """
+        :param revision: function returning the last revision of the lock read by the waiter
+        """
+        self.address = address
+        self.pool = pool
+        self.lockname = lockname
+        self.revision = revision
+        self.fallback = fallback
+
+    def __call__(self, timeout):
+        start = time.time()
+        if self.address is not None:
+            try:
+                self.wait(timeout)
+                return
+            except (OSError, ValueError) as error:
+                log.warning('The approval agent is unreachable, falling back to polling: %s' % error)
+                self.address = None
+        time.sleep(max(0, min(timeout, self.fallback) - (time.time() - start)))
+
+    def wait(self, timeout):
+        """ Send a wait request to the agent and block until its response """
+        request = {
+            'pool': self.pool,
+            'lockname': self.lockname,
+            'revision': self.revision(),
+            'timeout': timeout,
+        }
+        # The agent answers at the latest after the timeout and a tick
+        with connect(self.address, timeout=timeout + 60) as connection:
+            connection.sendall((json.dumps(request) + '\n').encode())
+            response = json.loads(connection.makefile().readline())
+        if 'error' in response:
+            raise ValueError(response['error'])
+        if response['changed']:
+            log.debug('Change of the lock %s seen by the agent' % self.lockname)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Approval agent coalescing the reads of the waiters of a node")
+    parser.add_argument("--listen", default='/var/run/concourse-approval.sock',
+                        help="path of the Unix socket, or host:port to listen on TCP on the loopback interface")
+    parser.add_argument("--interval", type=float, default=2, help="seconds between two reads of a pool")
+    parser.add_argument("--backend", default='dynamodb', help="storage backend: dynamodb or sqlite")
+    parser.add_argument("--database", default=':memory:', help="database file of the sqlite backend")
+    parser.add_argument("--region", default='eu-west-1', help="AWS region of the dynamodb backend")
+    parser.add_argument("-v", "--verbose", help="increase output verbosity", action="store_true")
+    args = parser.parse_args()
+    log.basicConfig(format="%(levelname)s: %(message)s", level=log.DEBUG if args.verbose else log.INFO)
+
+    # The credentials of dynamodb are read from the environment
+    storage = get_storage({
+        'backend': args.backend,
+        'database': args.database,
+        'AWS_DEFAULT_REGION': args.region,
+    })
+    if tcp_address(args.listen):
+        # Any client reaching the agent can make it read the pools of its storage
+        if not is_loopback(tcp_address(args.listen)[0]):
+            parser.error('The agent only listens on TCP on the loopback interface')
+        server = socketserver.ThreadingTCPServer(tcp_address(args.listen), AgentRequestHandler)
+    else:
+        if os.path.exists(args.listen):
+            os.unlink(args.listen)
+        server = socketserver.ThreadingUnixStreamServer(args.listen, AgentRequestHandler)
+    server.daemon_threads = True
+    server.agent = Agent(storage, interval=args.interval)
+    threading.Thread(target=server.agent.run, daemon=True).start()
+    log.info('Listening on %s' % args.listen)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
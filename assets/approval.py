@@ -1,40 +1,19 @@
 #!/usr/bin/env python3
 
 from datetime import (datetime, timezone, timedelta)
-from flywheel import Model, Field, Engine
-from flywheel.fields.types import DateTimeType
 from decimal import Decimal
 import simplejson as json
 import logging as log
 import os
 import sys
-import tempfile
 import time
-import uuid
 
+import logbuffer
+from stats import InvocationStats
+from storage import ARCHIVE_TABLE, Lock, get_storage, lock_id
 
-class Approval(Model):
-    """
-        We define the dynamodb model of the Approval locks
-    """
-
-    __metadata__ = {
-        '_name': 'concourse-approval',
-        'throughput': {
-            'read': 1,
-            'write': 1,
-        }
-    }
-    id = Field(type=str, range_key=True)
-    lockname = Field()
-    pool = Field(hash_key=True)
-    timestamp = Field(data_type=DateTimeType(naive=True))
-    claimed = Field(type=bool)
-    need_approval = Field(type=bool, default=False)
-    approved = Field(type=bool, nullable=True)
-    team = Field()
-    pipeline = Field()
-    description = Field(type=str, nullable=True)
+# The claims waiting behind the first ticket of the queue poll up to this many times slower
+QUEUE_MAX_SLOWDOWN = 4
 
 
 class ApprovalResource:
@@ -52,29 +31,42 @@ class ApprovalResource:
         # Namespace the approval lock
         self.data = json.loads(json_data)
         self.wait_lock = 10
+        self.wait_lock_min = 1
+        self.change_feed = False
+        self.change_feed_fallback = 300
+        self.feed = None
+        self.agent = None
+        self.agent_fallback = 300
         self.pool = ''
-        self.engine = Engine()
-
-        # allow debug logging to console for tests
-        if os.getenv('RESOURCE_DEBUG', False) or self.data.get('source', {}).get('debug', False):
-            log.basicConfig(level=log.DEBUG)
-        else:
-            logfile = tempfile.NamedTemporaryFile(delete=False, prefix='log')
-            log.basicConfig(level=log.DEBUG, filename=logfile.name)
-        stderr = log.StreamHandler()
-        stderr.setLevel(log.INFO)
-        log.getLogger().addHandler(stderr)
+        self.check_limit = 100
+        self.lease = None
+        self.history_ttl = None
+        self.queue = False
+        self.queue_position = None
+        self.stats = InvocationStats()
+        self.stats_sink = None
+        self.compact_after = None
+        self.archive_table = ARCHIVE_TABLE
+        self.storage = None
+
+        # allow debug logging to console for tests, else the debug log is only written if the command fails
+        source = self.data.get('source', {})
+        self.log_buffer = logbuffer.configure(
+            debug=bool(os.getenv('RESOURCE_DEBUG', False) or source.get('debug', False)),
+            secrets=[source.get(field) for field in logbuffer.SECRET_FIELDS])
 
         log.debug('command: %s', command_name)
-        log.debug('input: %s', self.data)
+        log.debug('input: %s', logbuffer.redact(self.data))
         log.debug('args: %s', command_argument)
-        log.debug('environment: %s', os.environ)
+        log.debug('build: %s', dict((key, value) for key, value in os.environ.items() if key.startswith('BUILD_')))
 
     def check_cmd(self, source, version):
         """
         Check for new version(s)
         This function will look on Dynamodb if there's a lock within the pool
-        and will return the last timestamps associated.
+        and will return the timestamps newer than the current version, oldest first.
+        At most check_limit versions are returned, the next check continues from the last one.
+        The marker of the pool is read first: if no lock changed since the version, the locks are not queried.
         :param source: is an arbitrary JSON object which specifies the location of the resource,
         including any credentials. This is passed verbatim from the pipeline configuration.
         :param version: is a JSON object with string fields, used to uniquely identify an instance of the resource.
@@ -85,13 +77,13 @@ class ApprovalResource:
 
         if not version:
             version = {"timestamp": '0'}
-        log.debug('source: %s', source)
+        log.debug('source: %s', logbuffer.redact(source))
         log.debug('version: %s', version)
-        approval_locks = self.engine.query(Approval)\
-            .filter(
-                Approval.timestamp >= datetime.fromtimestamp(Decimal(version.get('timestamp'))),
-                pool=self.pool) \
-            .all()
+        marker = self.storage.get_pool_marker(self.pool)
+        if marker is not None and marker.modified <= datetime.fromtimestamp(float(version.get('timestamp'))):
+            log.debug('No lock of the pool changed since the version, last change %s' % marker.modified)
+            return [version]
+        approval_locks = self.query_since(version, limit=self.check_limit)
         versions_list = []
         for lock in approval_locks:
             versions_list.append({"timestamp": "{timestamp}".format(timestamp=Decimal(lock.timestamp.timestamp()))})
@@ -111,7 +103,7 @@ class ApprovalResource:
         :param params: is an arbitrary JSON object passed along verbatim from params on a get.
         :return: a dict with the version fetched and the metadata of the lock
         """
-        log.debug('source: %s', source)
+        log.debug('source: %s', logbuffer.redact(source))
         log.debug('version: %s', version)
 
         if not version:
@@ -120,12 +112,25 @@ class ApprovalResource:
         # Does the get should wait for an approval or not ?
         if 'lock_name' in params and 'need_approval' in params:
             log.debug('Looking for the lock %s in the pool %s' % (params.get('lock_name'), self.pool))
-            approval_lock = self.query_lock(params.get('lock_name'))
+            poller = self.poller(params['lock_name'])
+            approval_lock = poller.poll(lambda: self.query_lock(params.get('lock_name')))
             if approval_lock:
+                refresh_approval = approval_lock
+                poller.observe(approval_lock.revision)
+                lease = params.get('lease', self.lease)
                 # We want to wait until the approve is done
                 while approval_lock.approved is None and approval_lock.need_approval:
                     # Query the lock item in the loop
-                    refresh_approval = self.query_lock(lock_name=params['lock_name'])
+                    refresh_approval = poller.poll(lambda: self.query_lock(lock_name=params['lock_name']))
+                    if refresh_approval.holder != approval_lock.holder:
+                        log.info("The lease of the lock %s has been taken over by another build, exiting" %
+                                 params['lock_name'])
+                        exit(1)
+                    # The build waiting for the approval keeps its lease alive
+                    if lease and refresh_approval.lease_expires and \
+                            refresh_approval.lease_expires - datetime.now() < timedelta(seconds=lease / 2):
+                        refresh_approval = self._extend_lease(params['lock_name'], lease, poller) or refresh_approval
+                    poller.observe(refresh_approval.revision)
 
                     # If the lock has timed out, then we override the refresh_approval to simulate a reject
                     if 'timeout' in params:
@@ -141,7 +146,13 @@ class ApprovalResource:
                         log.info("The lock %s is waiting for an approval" % params['lock_name'])
                     # If hasn't been approved or rejected, waiting a bit more
                     if refresh_approval.approved is None:
-                        time.sleep(self.wait_lock)
+                        # The pollers of the feed and the agent fall back to long intervals, the timeout must still
+                        # be kept
+                        limit = None
+                        if 'timeout' in params:
+                            limit = (approval_lock.timestamp + timedelta(minutes=params['timeout']) -
+                                     datetime.now()).total_seconds()
+                        poller.wait(limit=limit)
                         continue
 
                     # Is it approved ?
@@ -152,39 +163,37 @@ class ApprovalResource:
                 # If the lock has been rejected we should fail the job and release the lock
                 if not approval_lock.approved and approval_lock.need_approval:
                     log.info("The lock hasn't been approved, exiting")
-                    approval_lock.claimed = False
-                    approval_lock.approved = None
-                    self.engine.save(approval_lock, overwrite=True)
+                    holder = os.getenv('BUILD_ID')
+
+                    # The lock is read again and only released if the build still holds it and it wasn't approved
+                    # in the meantime. It is still pending when the get timed out.
+                    # The release hands the lock over to the queue and acknowledges the rejection to the put
+                    # overriding the approval.
+                    def release(approval_lock):
+                        if not approval_lock or approval_lock.holder != holder or approval_lock.approved is True:
+                            return None
+                        approval_lock.rejection_ack = approval_lock.revision
+                        return self._release_lock(approval_lock, datetime.now())
+
+                    released_lock = poller.poll(lambda: self.storage.update_lock(self.pool, params['lock_name'],
+                                                                                 release))
+                    if released_lock:
+                        self.touch_pool(released_lock, poller)
+                    else:
+                        log.info("The lock %s changed since it was rejected, leaving it as is" % params['lock_name'])
                     exit(1)
         elif 'lock_name' in params:
             approval_lock = self.query_lock(params.get('lock_name'))
         else:
             # There is no approval, we have just a normal lock. Let's fetch the lock
-            approval_lock = self.engine.query(Approval)\
-                .filter(
-                    Approval.timestamp >= datetime.fromtimestamp(Decimal(version.get('timestamp'))),
-                    pool=self.pool)\
-                .all()
+            approval_lock = self.query_since(version, limit=1, inclusive=True)
             if approval_lock:
                 approval_lock = approval_lock[0]
 
-        metadata = []
-
         if not approval_lock:
             log.info("No lock have been found")
             exit(0)
-        for key in approval_lock.keys_():
-            value = getattr(approval_lock, key)
-            if type(value) is datetime:
-                value = str(Decimal(value.timestamp()))
-            elif type(value) is bool:
-                value = str(value)
-            metadata.append(
-                {
-                    'name': key,
-                    'value': value
-                }
-            )
+        metadata = self.metadata([approval_lock])
 
         name_path = os.path.join(target_dir, 'name')
         with open(name_path, 'w') as name:
@@ -204,60 +213,262 @@ class ApprovalResource:
         """
         This method handle the claiming of a lock. If the lock is already claimed, it wait until the lock is
         available. Else, it create the lock.
+        The claim is a conditional write on the revision of the lock, so only one of concurrent claimers can win.
+        With the queue, a waiting claim enqueues a ticket in the lock and the release hands the lock over to the
+        first ticket, so the claims are served in order. The claims behind the first one poll slower.
         :param params: the params passed as parameters of the resource
         :return: the approval_lock item in dynamodb
         """
-        approval_lock = self.query_lock(lock_name=params['lock_name'])
-        need_approval = params.get('need_approval', False)
+        lock_name = params['lock_name']
         override_approval = params.get('override_approval', False)
-
-        if approval_lock:
-            # To override the previous approval, we need to reject the previous one
-            # Then the get will see it was rejected, will release the lock and fail the job
-            if override_approval:
-                approval_lock.approved = False
-                approval_lock.timestamp = datetime.now()
-                self.engine.save(approval_lock, overwrite=True)
+        poller = self.poller(lock_name)
+        pending_approval = False
+        # Time left before the lease of the current holder expires, when the lock is claimed with a lease
+        lease_left = None
+        holder = os.getenv('BUILD_ID')
+        # The tickets are identified by the build holding them
+        queue = self.queue and holder is not None
+        # A ticket must outlive the slowest poll of its build, which refreshes it after half its time. It is also the
+        # time a dead build holds a lock handed over to it, so it doesn't depend on the fallback of the feed or agent
+        ticket_ttl = 3 * self.wait_lock * QUEUE_MAX_SLOWDOWN
+        # Number of tickets before the ticket of the build, None when the build is not waiting in the queue
+        position = None
+        # Time after which the ticket of the build must be refreshed, in seconds since the epoch
+        refresh_at = None
+        # Position of the ticket when it entered the queue
+        entered = None
+        waiting = False
+
+        def reject(approval_lock):
+            nonlocal pending_approval
+            if not approval_lock:
+                return None
+            # Only the pending approval of a claimed lock can have a get waiting on it
+            pending_approval = approval_lock.claimed and approval_lock.need_approval and approval_lock.approved is None
+            approval_lock.approved = False
+            approval_lock.timestamp = datetime.now()
+            return approval_lock
+
+        def claim(approval_lock):
+            nonlocal lease_left, position, entered, waiting, refresh_at
+            waiting = False
+            tickets = self._live_tickets(approval_lock) if queue else []
+            mine = [ticket for ticket in tickets if ticket['holder'] == holder]
+            others = [ticket for ticket in tickets if ticket['holder'] != holder]
+            if position is not None and approval_lock and approval_lock.claimed and approval_lock.holder == holder:
+                # The release handed the lock over to the build, confirm the claim with its own params
+                approval_lock.queue = others or None
+                return self._claim_lock(approval_lock, lock_name, params, datetime.now())
+            held = approval_lock and self._held(approval_lock)
+            if not held and (not tickets or tickets[0]['holder'] == holder):
+                # The claim of an expired lease is conditional on its revision, like any claim
+                if approval_lock and queue:
+                    approval_lock.queue = others or None
+                return self._claim_lock(approval_lock, lock_name, params, datetime.now())
+            waiting = True
+            lease_left = self._lease_left(approval_lock) if held else None
+            poller.observe(approval_lock.revision)
+            if not queue:
+                return None
+            if mine:
+                position = tickets.index(mine[0])
+                if mine[0]['expires'] - time.time() > ticket_ttl / 2:
+                    refresh_at = mine[0]['expires'] - ticket_ttl / 2
+                    return None
+                mine[0]['expires'] = int(time.time()) + ticket_ttl
+                refresh_at = mine[0]['expires'] - ticket_ttl / 2
+            else:
+                ticket = {'holder': holder, 'expires': int(time.time()) + ticket_ttl}
+                refresh_at = ticket['expires'] - ticket_ttl / 2
+                # The override of the approval goes first, it must not wait for the builds already waiting
+                position = 0 if override_approval else len(tickets)
+                if entered is None:
+                    entered = position
+                tickets.insert(position, ticket)
+            approval_lock.queue = tickets
+            return approval_lock
+
+        # To override the previous approval, we need to reject the previous one
+        # Then the get will see it was rejected, will release the lock and fail the job
+        if override_approval:
+            rejected_lock = poller.poll(lambda: self.storage.update_lock(self.pool, lock_name, reject))
+            if rejected_lock:
+                self.touch_pool(rejected_lock, poller)
                 log.info("Rejecting the previous approval")
-                # Let the get fail before acquiring the new lock
-                time.sleep(self.wait_lock + 5)
-
-            # We want to wait until the lock is not claimed
-            log_only_once = False
-            while approval_lock.claimed:
-                if not log_only_once:
-                    log_only_once = True
-                    log.info("The lock %s is already claimed" % params['lock_name'])
-                refresh_approval = self.query_lock(lock_name=params['lock_name'])
-                if not refresh_approval:
-                    log.info("The lock does not exist")
-                    exit(1)
-                if not refresh_approval.claimed:
-                    approval_lock.claimed = False
+                if pending_approval:
+                    # Let the get fail before acquiring the new lock
+                    self._wait_rejection_ack(rejected_lock, poller,
+                                             timeout=params.get('override_timeout', self.wait_lock + 5))
+
+        # We want to wait until the lock is not claimed
+        log_position = None
+        while True:
+            approval_lock = poller.poll(lambda: self.storage.update_lock(self.pool, lock_name, claim))
+            if not waiting:
+                break
+            if approval_lock:
+                # The ticket was saved, the next poll must not take its own write for a change of the lock
+                poller.observe(approval_lock.revision)
+            if log_position is None or position != log_position:
+                log_position = position
+                if position is None:
+                    log.info("The lock %s is already claimed" % lock_name)
                 else:
-                    time.sleep(self.wait_lock)
+                    log.info("The lock %s is already claimed, %s builds before this one in the queue" %
+                             (lock_name, position))
+            # Try again as soon as the lease expires, and in time to refresh the ticket
+            limit = lease_left
+            if position is not None:
+                refresh_in = refresh_at - time.time()
+                limit = refresh_in if limit is None else min(limit, refresh_in)
+            if position:
+                # Only the first ticket can get the lock, the ones behind it poll slower
+                poller.wait(limit=limit, slowdown=min(position + 1, QUEUE_MAX_SLOWDOWN))
+            else:
+                poller.wait(limit=limit)
+        self.touch_pool(approval_lock, poller)
+        self.queue_position = entered
+        log.info("Claiming the lock %s" % lock_name)
 
-        else:
-            approval_lock = Approval(
-                id=uuid.uuid4().urn[9:],
-                lockname=params['lock_name'],
+        return approval_lock
+
+    def _do_claim_all(self, params):
+        """
+        This method handle the claiming of several locks at once. If one of the locks is claimed, it waits until
+        all of them are available. Else, it claims all of them in a single transaction.
+        As the locks are never partially claimed, builds claiming overlapping locks can't deadlock.
+        :param params: the params passed as parameters of the resource
+        :return: the list of approval_lock items in dynamodb
+        """
+        if params.get('override_approval'):
+            log.error('override_approval is not supported with lock_names')
+            exit(1)
+        lock_names = sorted(set(params['lock_names']))
+        poller = self.poller()
+        # Time left before the last lease of the current holders expires, when all of them have a lease
+        lease_left = None
+
+        def claim(approval_locks):
+            nonlocal lease_left
+            held = [approval_lock for approval_lock in approval_locks if approval_lock and self._held(approval_lock)]
+            if held:
+                leases = [self._lease_left(approval_lock) for approval_lock in held]
+                lease_left = None if None in leases else max(leases)
+                poller.observe(tuple(approval_lock.revision for approval_lock in held))
+                return None
+            now = datetime.now()
+            return [self._claim_lock(approval_lock, lock_name, params, now)
+                    for approval_lock, lock_name in zip(approval_locks, lock_names)]
+
+        # We want to wait until none of the locks is claimed
+        log_only_once = False
+        while True:
+            approval_locks = poller.poll(lambda: self.storage.update_locks(self.pool, lock_names, claim))
+            if approval_locks:
+                break
+            if not log_only_once:
+                log_only_once = True
+                log.info("One of the locks %s is already claimed" % ', '.join(lock_names))
+            # Try again as soon as the leases expire
+            poller.wait(limit=lease_left)
+        self.touch_pool(approval_locks[0], poller)
+        log.info("Claiming the locks %s" % ', '.join(lock_names))
+
+        return approval_locks
+
+    def _live_tickets(self, approval_lock):
+        """
+        This method lists the tickets of the builds waiting for a lock, without the expired ones
+        :param approval_lock: the lock, or None
+        :return: the tickets, first come first
+        """
+        if not approval_lock or not approval_lock.queue:
+            return []
+        now = time.time()
+        return [ticket for ticket in approval_lock.queue if ticket['expires'] > now]
+
+    def _held(self, approval_lock):
+        """
+        This method tells if a lock is held, by a claim without a lease or with a lease not expired yet
+        :param approval_lock: the lock
+        :return: True if the lock can't be claimed
+        """
+        if not approval_lock.claimed:
+            return False
+        return approval_lock.lease_expires is None or approval_lock.lease_expires > datetime.now()
+
+    def _lease_left(self, approval_lock):
+        """
+        This method computes the time left before the lease of a lock expires
+        :param approval_lock: the lock
+        :return: the time in seconds, or None if the lock is not claimed with a lease
+        """
+        if approval_lock.lease_expires is None:
+            return None
+        return (approval_lock.lease_expires - datetime.now()).total_seconds()
+
+    def _claim_lock(self, approval_lock, lock_name, params, now):
+        """
+        This method sets the fields of a claimed lock
+        :param approval_lock: the lock, None to create it
+        :param lock_name: the name of the lock
+        :param params: the params passed as parameters of the resource
+        :param now: the timestamp of the claim
+        :return: the claimed lock, to save
+        """
+        if not approval_lock:
+            approval_lock = Lock(
+                id=lock_id(self.pool, lock_name),
+                lockname=lock_name,
                 pool=self.pool,
-                claimed=True,
                 team=os.getenv('BUILD_TEAM_NAME', "team"),
                 pipeline=os.getenv('BUILD_PIPELINE_NAME', "pipeline"),
                 description=params.get('description', None)
             )
-
-        if need_approval:
+        elif approval_lock.claimed and approval_lock.holder != os.getenv('BUILD_ID'):
+            log.info("The lease of the lock %s expired at %s, taking it over" %
+                     (lock_name, approval_lock.lease_expires))
+        lease = params.get('lease', self.lease)
+        if params.get('need_approval', False):
             approval_lock.need_approval = True
         approval_lock.claimed = True
         approval_lock.approved = None
-        approval_lock.timestamp = datetime.now()
-        self.engine.save(approval_lock, overwrite=True)
-        log.info("Claiming the lock %s" % params['lock_name'])
-
+        approval_lock.timestamp = now
+        approval_lock.holder = os.getenv('BUILD_ID')
+        if lease:
+            approval_lock.lease_expires = now + timedelta(seconds=lease)
+            approval_lock.expires = self.expires(approval_lock.lease_expires)
+        else:
+            # A lock claimed without a lease is never deleted
+            approval_lock.lease_expires = None
+            approval_lock.expires = None
         return approval_lock
 
+    def _wait_rejection_ack(self, rejected_lock, poller, timeout):
+        """
+        This method waits until the get waiting on a rejected approval acknowledged the rejection.
+        The get records the revision it saw in the rejection_ack field when it releases the lock, which is the
+        revision of the rejection or a later one.
+        :param rejected_lock: the lock as saved by the rejection
+        :param poller: the poller of the claim
+        :param timeout: the maximum time to wait for the acknowledgement, in seconds
+        :return: True if the rejection was acknowledged
+        """
+        deadline = time.time() + timeout
+        while True:
+            approval_lock = poller.poll(lambda: self.query_lock(rejected_lock.lockname))
+            if approval_lock:
+                poller.observe(approval_lock.revision)
+            if not approval_lock or (approval_lock.rejection_ack is not None and
+                                     approval_lock.rejection_ack >= rejected_lock.revision):
+                log.info("The rejection of the previous approval has been acknowledged")
+                return True
+            if time.time() >= deadline:
+                log.info("The rejection of the previous approval hasn't been acknowledged after %s seconds" % timeout)
+                return False
+            # The pollers of the feed and the agent fall back to long intervals, the timeout must still be kept
+            poller.wait(limit=deadline - time.time())
+
     def _do_release(self, params):
         """
         This method handle the release of a claimed lock
@@ -265,91 +476,304 @@ class ApprovalResource:
         :param params: the params passed as parameters of the resource
         :return: the approval_lock item in dynamodb
         """
-        approval_lock = self.query_lock(lock_name=params['lock_name'])
+        def release(approval_lock):
+            if not approval_lock:
+                return None
+            return self._release_lock(approval_lock, datetime.now())
+
+        poller = self.poller()
+        approval_lock = poller.poll(lambda: self.storage.update_lock(self.pool, params['lock_name'], release))
 
         if not approval_lock:
             log.info("The lock does not exist")
             exit(1)
+        self.touch_pool(approval_lock, poller)
+        log.info("Releasing the lock %s" % params['lock_name'])
 
-        approval_lock.claimed = False
+        return approval_lock
+
+    def _do_release_all(self, params):
+        """
+        This method handle the release of several locks at once, in a single transaction
+
+        :param params: the params passed as parameters of the resource
+        :return: the list of approval_lock items in dynamodb
+        """
+        lock_names = sorted(set(params['lock_names']))
+
+        def release(approval_locks):
+            if not all(approval_locks):
+                return None
+            now = datetime.now()
+            return [self._release_lock(approval_lock, now) for approval_lock in approval_locks]
+
+        poller = self.poller()
+        approval_locks = poller.poll(lambda: self.storage.update_locks(self.pool, lock_names, release))
+
+        if not approval_locks:
+            log.info("One of the locks does not exist")
+            exit(1)
+        self.touch_pool(approval_locks[0], poller)
+        log.info("Releasing the locks %s" % ', '.join(lock_names))
+
+        return approval_locks
+
+    def _release_lock(self, approval_lock, now):
+        """
+        This method sets the fields of a released lock
+        :param approval_lock: the lock
+        :param now: the timestamp of the release
+        :return: the released lock, to save
+        """
+        tickets = self._live_tickets(approval_lock)
         approval_lock.approved = None
-        approval_lock.timestamp = datetime.now()
-        self.engine.save(approval_lock, overwrite=True)
-        log.info("Releasing the lock %s" % params['lock_name'])
+        approval_lock.timestamp = now
+        if tickets:
+            # Hand the lock over to the first build waiting in the queue, until its ticket expires.
+            # The build confirms the claim with its own params when it sees it
+            ticket = tickets.pop(0)
+            approval_lock.claimed = True
+            approval_lock.holder = ticket['holder']
+            approval_lock.lease_expires = datetime.fromtimestamp(ticket['expires'])
+            approval_lock.expires = self.expires(approval_lock.lease_expires)
+            approval_lock.queue = tickets or None
+            log.info("Handing the lock %s over to the build %s" % (approval_lock.lockname, ticket['holder']))
+            return approval_lock
+        approval_lock.claimed = False
+        approval_lock.holder = None
+        approval_lock.lease_expires = None
+        approval_lock.expires = self.expires()
+        approval_lock.queue = None
+        return approval_lock
+
+    def _compact(self):
+        """
+        This method moves a batch of the locks of the pool released more than compact_after seconds ago to the
+        archive table. It runs after a release, which doesn't fail if the compaction does.
+        """
+        # Only the releases compacting the pool need this module
+        from compaction import COMPACT_BATCH, TableArchive, compact
+
+        before = datetime.now() - timedelta(seconds=self.compact_after)
+        try:
+            count = compact(self.storage, self.pool, before, TableArchive(self.storage, self.archive_table),
+                            limit=COMPACT_BATCH)
+        except Exception as error:
+            log.warning('Unable to compact the pool %s: %s' % (self.pool, error))
+            return
+        if count:
+            log.info("%d released lock(s) moved to the archive table %s" % (count, self.archive_table))
+
+    def _do_heartbeat(self, params):
+        """
+        This method extends the lease of a lock claimed by the build
+
+        :param params: the params passed as parameters of the resource
+        :return: the approval_lock item in dynamodb
+        """
+        lease = params.get('lease', self.lease)
+        if not lease:
+            log.error('You must set a lease on params or source to send a heartbeat')
+            exit(1)
+
+        approval_lock = self._extend_lease(params['lock_name'], lease, self.poller())
+
+        if not approval_lock:
+            log.info("The lock %s is not claimed by this build" % params['lock_name'])
+            exit(1)
+        log.info("Extending the lease of the lock %s until %s" % (params['lock_name'], approval_lock.lease_expires))
 
         return approval_lock
 
+    def _extend_lease(self, lock_name, lease, poller):
+        """
+        This method extends the lease of a lock, if it is still claimed by the build
+        :param lease: the new duration of the lease from now, in seconds
+        :param poller: the poller backing off while the storage is throttled
+        :return: the lock, or None if the build doesn't hold it
+        """
+        holder = os.getenv('BUILD_ID')
+
+        def extend(approval_lock):
+            if not approval_lock or not approval_lock.claimed or approval_lock.holder != holder:
+                return None
+            approval_lock.lease_expires = datetime.now() + timedelta(seconds=lease)
+            approval_lock.expires = self.expires(approval_lock.lease_expires)
+            return approval_lock
+
+        return poller.poll(lambda: self.storage.update_lock(self.pool, lock_name, extend))
+
+    def expires(self, after=None):
+        """
+        This method computes the time after which dynamodb deletes a lock, history_ttl seconds after a time
+        :param after: the time the lock is kept until, now by default
+        :return: the time in seconds since the epoch, or None if history_ttl is not set
+        """
+        if not self.history_ttl:
+            return None
+        return int((after or datetime.now()).timestamp()) + self.history_ttl
+
+    def poller(self, lock_name=None):
+        """
+        This method builds the poller scheduling the reads of a wait loop.
+        With the agent, the poller is woken up when the agent sees a change of the lock, and only reads it every
+        agent_fallback seconds otherwise. If the agent can't be reached, the lock is read every wait_lock seconds.
+        With the change feed, the poller is woken up by the changes of the lock and only reads it every
+        change_feed_fallback seconds otherwise, in case a change was missed. If the feed fails, the lock is read
+        every wait_lock seconds.
+        :param lock_name: the name of the lock the loop is waiting on
+        :return: a Poller between wait_lock_min and wait_lock seconds
+        """
+        # Only the wait loops need these modules, check doesn't import them
+        from changefeed import FeedWaiter
+        from poller import Poller
+
+        if lock_name and self.agent:
+            from agent import AgentWaiter
+            poller = Poller(min_interval=self.agent_fallback, max_interval=self.agent_fallback)
+            # The agent wakes up the poller when the lock differs from the last revision read
+            poller.sleep = AgentWaiter(self.agent, self.pool, lock_name, revision=lambda: poller.state,
+                                       fallback=self.wait_lock)
+            return poller
+        if lock_name and self.change_feed:
+            if self.feed is None:
+                try:
+                    self.feed = self.storage.change_feed()
+                    # The feed starts at the end of the stream, before the lock is first read, so no change is lost
+                    if self.feed is not None:
+                        self.feed.refresh_shards()
+                except Exception as error:
+                    log.warning('Unable to open the change feed, falling back to polling: %s' % error)
+                    self.change_feed = False
+            if self.feed is not None:
+                return Poller(min_interval=self.change_feed_fallback, max_interval=self.change_feed_fallback,
+                              sleep=FeedWaiter(self.feed, self.pool, lock_name, fallback=self.wait_lock))
+        return Poller(min_interval=self.wait_lock_min, max_interval=self.wait_lock)
+
+    def touch_pool(self, approval_lock, poller):
+        """
+        This method records that a lock of the pool changed, so the next check queries the locks again.
+        It must be called once the lock is saved.
+        :param approval_lock: the saved lock
+        :param poller: the poller backing off while the storage is throttled
+        """
+        poller.poll(lambda: self.storage.touch_pool(self.pool, approval_lock.timestamp))
+
     def query_lock(self, lock_name):
         """
         This method is used to query the lock in the approval loop to check if there is a change on it
         :param lock_name: The name of the lock to fetch
-        :return: the dynamodb item
+        :return: the lock or None if the lock does not exist
         """
-        approval_lock = self.engine.query(Approval) \
-            .filter(
-                lockname=lock_name,
-                pool=self.pool) \
-            .all()
-        if approval_lock:
-            approval_lock = approval_lock[0]
-        return approval_lock
+        return self.storage.get_lock(self.pool, lock_name)
+
+    def query_since(self, version, limit, inclusive=False):
+        """
+        This method fetches the locks of the pool changed after a version
+        :param version: the version to start from
+        :param limit: the maximum number of locks to read
+        :param inclusive: if True, a lock with the exact timestamp of the version is returned too
+        :return: the locks ordered by timestamp
+        """
+        since = datetime.fromtimestamp(float(version.get('timestamp')))
+        return self.storage.query_since(self.pool, since, limit, inclusive=inclusive)
 
     def out_cmd(self, target_dir, source, params):
         """
         This method is responsible to acquire or release a lock. If the lock doesn't exist yet, then the method
         create it automatically.
         If a lock is already acquired, the method will wait indefinitely until being able to acquire it.
+        With lock_names, all the locks are acquired or released at once.
         :param target_dir:
         :param source: is the same value as passed to check.
         :param params: is an arbitrary JSON object passed along verbatim from params on a put.
         :return: a dict with the version fetched and the metadata of the lock
         """
-        metadata = []
-
-        if 'lock_name' not in params:
-            log.error('You must set a lock_name on params')
+        lock_names = params.get('lock_names')
+        if 'lock_name' not in params and not lock_names:
+            log.error('You must set a lock_name or lock_names on params')
         if 'action' not in params:
             log.error('You must set an action on params')
 
         if 'claim' in params['action']:
-            approval_lock = self._do_claim(params=params)
+            approval_locks = self._do_claim_all(params=params) if lock_names else [self._do_claim(params=params)]
         elif 'release' in params['action']:
-            approval_lock = self._do_release(params=params)
+            approval_locks = self._do_release_all(params=params) if lock_names else [self._do_release(params=params)]
+            if self.compact_after:
+                self._compact()
+        elif 'heartbeat' in params['action']:
+            approval_locks = [self._do_heartbeat(params=dict(params, lock_name=lock_name))
+                              for lock_name in lock_names or [params['lock_name']]]
         else:
             log.error('Please use an available action')
             exit(1)
 
-        metadata = []
-        for key in approval_lock.keys_():
-            value = getattr(approval_lock, key)
-            if type(value) is datetime:
-                value = str(Decimal(value.timestamp()))
-            elif type(value) is bool:
-                value = str(value)
-
-            metadata.append(
-                {
-                    'name': key,
-                    'value': value
-                }
-            )
+        metadata = self.metadata(approval_locks, prefixed=bool(lock_names))
 
         name_path = os.path.join(target_dir, 'name')
         with open(name_path, 'w') as name:
-            name.write(approval_lock.lockname)
+            name.write('\n'.join(approval_lock.lockname for approval_lock in approval_locks))
 
         metadata_path = os.path.join(target_dir, 'metadata')
         with open(metadata_path, 'w') as metadata_file:
             json.dump(metadata, metadata_file)
 
+        timestamp = max(approval_lock.timestamp for approval_lock in approval_locks)
         return {
-            'version': {"timestamp": "{timestamp}".format(
-                timestamp=Decimal(approval_lock.timestamp.timestamp()))},
+            'version': {"timestamp": "{timestamp}".format(timestamp=Decimal(timestamp.timestamp()))},
             'metadata': metadata,
         }
 
+    def metadata(self, approval_locks, prefixed=False):
+        """
+        This method builds the metadata of the locks returned by in or out, followed by the position of the claim
+        in the queue and the statistics of the command.
+        Concourse reads the values of the metadata as strings, so every value set is converted to one.
+        :param approval_locks: the list of locks
+        :param prefixed: if True, the name of each field is prefixed by the name of its lock
+        :return: the list of metadata entries
+        """
+        metadata = []
+        for approval_lock in approval_locks:
+            prefix = approval_lock.lockname + '.' if prefixed else ''
+            for key in approval_lock.keys_():
+                metadata.append({'name': prefix + key, 'value': getattr(approval_lock, key)})
+        # Number of builds waiting before this one when the claim entered the queue
+        if self.queue_position is not None:
+            metadata.append({'name': 'queue_position', 'value': self.queue_position})
+        metadata.extend(self.stats.metadata())
+
+        for entry in metadata:
+            value = entry['value']
+            if type(value) is datetime:
+                entry['value'] = str(Decimal(value.timestamp()))
+            elif type(value) is list:
+                entry['value'] = json.dumps(value)
+            elif value is not None and type(value) is not str:
+                entry['value'] = str(value)
+        return metadata
+
     def run(self):
-        """Parse input/arguments, perform requested command return output."""
+        """Parse input/arguments, perform requested command return output, with the debug log if it fails."""
+        try:
+            return self.execute()
+        except SystemExit as error:
+            if error.code:
+                self.dump_log()
+            raise
+        except Exception:
+            self.dump_log()
+            raise
+
+    def dump_log(self):
+        """
+        This method writes the debug records kept in memory to stderr, when the command fails
+        """
+        if self.log_buffer is not None:
+            self.log_buffer.dump()
+
+    def execute(self):
+        """Perform the requested command and return its output."""
         # Extract informations from the json
         source = self.data.get('source', {})
         params = self.data.get('params', {})
@@ -360,6 +784,18 @@ class ApprovalResource:
         os.environ['AWS_SECRET_ACCESS_KEY'] = source.get('AWS_SECRET_ACCESS_KEY', '')
         os.environ['AWS_DEFAULT_REGION'] = source.get('AWS_DEFAULT_REGION', "eu-west-1")
         self.wait_lock = source.get('wait_lock', 10)
+        self.wait_lock_min = source.get('wait_lock_min', 1)
+        self.change_feed = source.get('change_feed', False)
+        self.change_feed_fallback = source.get('change_feed_fallback', 300)
+        self.agent = source.get('agent', None)
+        self.agent_fallback = source.get('agent_fallback', 300)
+        self.check_limit = source.get('check_limit', 100)
+        self.lease = source.get('lease', None)
+        self.history_ttl = source.get('history_ttl', None)
+        self.queue = source.get('queue', False)
+        self.stats_sink = source.get('stats', None)
+        self.compact_after = source.get('compact_after', None)
+        self.archive_table = source.get('archive_table', ARCHIVE_TABLE)
 
         # Ensure we are receiving the required parameters on the configuration
         if 'pool' not in source:
@@ -368,23 +804,44 @@ class ApprovalResource:
         else:
             self.pool = source.get('pool')
 
-        # Configure the connection to Dynamodb
-        self.engine.connect_to_region(os.environ.get('AWS_DEFAULT_REGION', 'eu-west-1'))
-        # Register our model with the engine so it can create the Dynamo table
-        self.engine.register(Approval)
-        # Create the dynamo table for our registered model
-        self.engine.create_schema()
+        # Configure the storage of the locks, dynamodb by default
+        try:
+            self.storage = self.stats.instrument(get_storage(source))
+        except ValueError as error:
+            log.error(error)
+            exit(1)
 
         # Define which operation to perform
-        if self.command_name == 'check':
-            response = self.check_cmd(source, version)
-        elif self.command_name == 'in':
-            response = self.in_cmd(self.command_argument[0], source, version, params)
-        else:
-            response = self.out_cmd(self.command_argument[0], source, params)
+        try:
+            if self.command_name == 'check':
+                response = self.check_cmd(source, version)
+            elif self.command_name == 'in':
+                response = self.in_cmd(self.command_argument[0], source, version, params)
+            else:
+                response = self.out_cmd(self.command_argument[0], source, params)
+        finally:
+            self.emit_stats()
 
         return json.dumps(response)
 
+    def emit_stats(self):
+        """
+        This method logs the statistics of the storage requests of the command, and sends them to the stats sink
+        of the source. A sink which can't be reached doesn't fail the command.
+        """
+        log.debug('stats: %s', self.stats.totals())
+        if not self.stats_sink:
+            return
+        tags = {
+            'pool': self.pool,
+            'team': os.getenv('BUILD_TEAM_NAME'),
+            'pipeline': os.getenv('BUILD_PIPELINE_NAME'),
+        }
+        try:
+            self.stats.emit(self.stats_sink, self.command_name, tags)
+        except OSError as error:
+            log.warning('Unable to send the statistics to %s: %s' % (self.stats_sink, error))
+
 if __name__ == "__main__":
     print(ApprovalResource(command_name=os.path.basename(__file__),
                            json_data=sys.stdin.read(),
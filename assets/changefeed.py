@@ -0,0 +1,150 @@
+"""
+    Change feed of the approval locks.
+    A waiting get or put can block on the feed instead of polling the table: it is woken up as soon as a change
+    of its lock shows up in the stream, and only then reads the lock again.
+"""
+
+from decimal import Decimal
+import logging as log
+import time
+
+from storage import lock_id
+
+# The fields of a lock whose changes wake up the waiters. The holder changes when the lock is handed over to the
+# first build of its queue, or when an expired lease is taken over, while the lock stays claimed
+WATCHED_FIELDS = ('approved', 'claimed', 'holder')
+
+
+def decode(value):
+    """ Decode a value of a stream record, in the dynamodb JSON format """
+    if 'S' in value:
+        return value['S']
+    if 'N' in value:
+        return Decimal(value['N'])
+    if 'BOOL' in value:
+        return value['BOOL']
+    return None
+
+
+def decode_image(image):
+    """ Decode the image of an item in a stream record """
+    return dict((key, decode(value)) for key, value in (image or {}).items())
+
+
+class StreamFeed:
+    """
+        Consume a DynamoDB Streams API: the dynamodbstreams client of botocore, or a local stand-in exposing
+        describe_stream, get_shard_iterator and get_records.
+        The consumer starts at the end of the open shards, so only the changes made after it started are seen: it must
+        be started with refresh_shards before the lock it waits on is read.
+    """
+
+    def __init__(self, client, stream_arn, interval=0.5):
+        self.client = client
+        self.stream_arn = stream_arn
+        self.interval = interval
+        # Iterator of each shard being read, None once a shard is closed and fully read
+        self.iterators = {}
+        self.started = False
+
+    def shards(self):
+        """ List the shards of the stream """
+        kwargs = {'StreamArn': self.stream_arn}
+        while True:
+            description = self.client.describe_stream(**kwargs)['StreamDescription']
+            for shard in description.get('Shards', []):
+                yield shard
+            if not description.get('LastEvaluatedShardId'):
+                break
+            kwargs['ExclusiveStartShardId'] = description['LastEvaluatedShardId']
+
+    def refresh_shards(self):
+        """
+        Start reading the shards not seen yet. On start only the open shards are read, from their end.
+        Shards opened later are children of the ones being read, so they are read from their start.
+        """
+        for shard in self.shards():
+            shard_id = shard['ShardId']
+            if shard_id in self.iterators:
+                continue
+            if not self.started:
+                if shard.get('SequenceNumberRange', {}).get('EndingSequenceNumber'):
+                    continue
+                iterator_type = 'LATEST'
+            else:
+                iterator_type = 'TRIM_HORIZON'
+            self.iterators[shard_id] = self.client.get_shard_iterator(
+                StreamArn=self.stream_arn, ShardId=shard_id, ShardIteratorType=iterator_type)['ShardIterator']
+        self.started = True
+
+    def records(self):
+        """
+        Read the records added to the stream since the previous call
+        :return: the list of records, with their keys and images decoded
+        """
+        if not self.started:
+            self.refresh_shards()
+        records = []
+        closed = False
+        for shard_id, iterator in list(self.iterators.items()):
+            if iterator is None:
+                continue
+            response = self.client.get_records(ShardIterator=iterator)
+            self.iterators[shard_id] = response.get('NextShardIterator')
+            if self.iterators[shard_id] is None:
+                closed = True
+            for record in response.get('Records', []):
+                change = record['dynamodb']
+                records.append({
+                    'event': record.get('eventName'),
+                    'keys': decode_image(change.get('Keys')),
+                    'old': decode_image(change.get('OldImage')),
+                    'new': decode_image(change.get('NewImage')),
+                })
+        if closed:
+            self.refresh_shards()
+        return records
+
+    def wait(self, pool, lockname, timeout):
+        """
+        Block until the approved, claimed or holder field of a lock changes, or the timeout expires
+        :param timeout: the maximum time to wait, in seconds
+        :return: True if a change was seen, False on timeout
+        """
+        key = {'pool': pool, 'id': lock_id(pool, lockname)}
+        deadline = time.time() + timeout
+        while True:
+            for record in self.records():
+                if record['keys'] != key:
+                    continue
+                if any(record['old'].get(field) != record['new'].get(field) for field in WATCHED_FIELDS):
+                    log.debug('Change of the lock %s seen in the stream' % lockname)
+                    return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.interval, remaining))
+
+
+class FeedWaiter:
+    """
+        Sleep function of a Poller waking up on the changes of a lock.
+        If the feed fails, it is dropped and the waiter falls back to polling every fallback seconds.
+    """
+
+    def __init__(self, feed, pool, lockname, fallback):
+        self.feed = feed
+        self.pool = pool
+        self.lockname = lockname
+        self.fallback = fallback
+
+    def __call__(self, timeout):
+        start = time.time()
+        if self.feed is not None:
+            try:
+                self.feed.wait(self.pool, self.lockname, timeout)
+                return
+            except Exception as error:
+                log.warning('The change feed failed, falling back to polling: %s' % error)
+                self.feed = None
+        time.sleep(max(0, min(timeout, self.fallback) - (time.time() - start)))
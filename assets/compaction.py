@@ -0,0 +1,93 @@
+"""
+    Compaction of the history of the pools.
+    A lock is kept in its pool once released, so the pools grow with every lock name ever claimed. The compaction
+    moves the locks released for a while to an archive, a table or a local file of JSON lines, and deletes them
+    from the pool. A compacted lock is created again by its next claim, its revision continuing after the highest
+    revision compacted in its pool, so the revision of a lock never goes back.
+"""
+
+import json
+import logging as log
+
+from storage import LockConflict
+
+# Number of locks archived together
+COMPACT_BATCH = 25
+
+
+class FileArchive:
+    """
+        Archive the locks as JSON lines appended to a local file
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def save(self, locks):
+        with open(self.path, 'a') as archive:
+            for lock in locks:
+                archive.write(json.dumps(lock.to_dict(), default=str, sort_keys=True) + '\n')
+
+    def __str__(self):
+        return 'the file %s' % self.path
+
+
+class TableArchive:
+    """
+        Archive the locks in a table of the storage
+    """
+
+    def __init__(self, storage, table):
+        self.storage = storage
+        self.table = table
+
+    def save(self, locks):
+        self.storage.archive_locks(locks, table=self.table)
+
+    def __str__(self):
+        return 'the table %s' % self.table
+
+
+def compact(storage, pool, before, archive, limit=None):
+    """
+    Move the locks of a pool released before a timestamp to an archive, oldest first.
+    The locks are archived before they are deleted, and the deletion is conditional on their revision: a lock
+    claimed in the meantime is kept in the pool, its archived copy remains as history.
+    :param archive: a FileArchive or a TableArchive
+    :param limit: the maximum number of locks to compact, all of them by default
+    :return: the number of locks deleted from the pool
+    """
+    count = 0
+    batch = []
+    for lock in storage.query_before(pool, before, claimed=False):
+        # A released lock with tickets is about to be claimed by the first waiting build
+        if lock.queue:
+            continue
+        batch.append(lock)
+        if len(batch) == COMPACT_BATCH or (limit is not None and count + len(batch) >= limit):
+            count += compact_batch(storage, batch, archive)
+            batch = []
+            if limit is not None and count >= limit:
+                break
+    if batch:
+        count += compact_batch(storage, batch, archive)
+    return count
+
+
+def compact_batch(storage, locks, archive):
+    """
+    Archive then delete locks of a pool
+    :return: the number of deleted locks
+    """
+    archive.save(locks)
+    # A lock created again once deleted must not reuse the revisions of its previous life
+    storage.record_compacted(locks[0].pool, max(lock.revision for lock in locks))
+    count = 0
+    for lock in locks:
+        try:
+            storage.delete_lock(lock)
+            count += 1
+        except LockConflict:
+            log.debug('The lock %s changed since it was archived, keeping it' % lock.lockname)
+    log.debug('%d lock(s) of %d moved to %s' % (count, len(locks), archive))
+    return count
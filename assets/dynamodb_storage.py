@@ -0,0 +1,635 @@
+"""
+    DynamoDB storage of the approval locks, through flywheel
+"""
+
+from botocore.config import Config
+import botocore.session
+from dynamo3 import CheckFailed, DynamoDBConnection, DynamoDBError, DynamoKey, IndexUpdate, Throughput
+from flywheel import Model, Field, Engine, GlobalIndex
+from flywheel.fields.types import DateTimeType
+from datetime import datetime
+import functools
+import json
+import logging as log
+import os
+import tempfile
+import time
+
+from storage import ARCHIVE_TABLE, Lock, LockConflict, PoolMarker, Storage, Throttled, archive_id, lock_id
+
+# Error codes returned by dynamodb when a request is throttled
+THROTTLING_CODES = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+
+# Number of times dynamo3 sends a throttled request again before raising it. The pollers of the resource back off
+# from the throttling themselves, with jitter, instead of blocking in the exponential sleep of dynamo3
+THROTTLE_RETRIES = 2
+
+# botocore also retries each request dynamo3 sends, up to 10 times and about 25 seconds for dynamodb by default.
+# It only retries once here, so a throttled request reaches the pollers after a few seconds at most
+CLIENT_CONFIG = Config(retries={'max_attempts': 1, 'mode': 'standard'})
+
+# Range key of the marker item of each pool. The marker has no timestamp, so it stays out of the ts-index.
+# Its modified attribute is an ISO 8601 string, so the conditional update can compare it
+MARKER_ID = 'pool-marker'
+
+# Bumped when the tables or indexes of the model change, so the cached schema verifications are done again
+SCHEMA_VERSION = 4
+
+# Interval between the verifications of the status of an index being built, in seconds
+INDEX_POLL_INTERVAL = 10
+
+
+class Approval(Model):
+    """
+        We define the dynamodb model of the Approval locks
+    """
+
+    __metadata__ = {
+        '_name': 'concourse-approval',
+        'throughput': {
+            'read': 1,
+            'write': 1,
+        },
+        # Locks of a pool ordered by timestamp, used by check to only read the newer versions
+        # and pool of a lock id, used by the CLI to find a lock from its id only
+        'global_indexes': [
+            GlobalIndex.all('ts-index', 'pool', 'timestamp').throughput(read=1, write=1),
+            GlobalIndex.keys('id-index', 'id').throughput(read=1, write=1),
+        ],
+    }
+    id = Field(type=str, range_key=True)
+    lockname = Field()
+    pool = Field(hash_key=True)
+    timestamp = Field(data_type=DateTimeType(naive=True))
+    claimed = Field(type=bool)
+    need_approval = Field(type=bool, default=False)
+    approved = Field(type=bool, nullable=True)
+    team = Field()
+    pipeline = Field()
+    description = Field(type=str, nullable=True)
+    revision = Field(type=int, nullable=True)
+    rejection_ack = Field(type=int, nullable=True)
+    holder = Field(type=str, nullable=True)
+    lease_expires = Field(data_type=DateTimeType(naive=True), nullable=True)
+    # Time to live of the item, in seconds since the epoch
+    expires = Field(type=int, nullable=True)
+    # Tickets of the builds waiting for the lock, as a JSON list
+    queue = Field(type=str, nullable=True)
+
+
+def raise_throttled(method):
+    """ Decorator translating the throttling errors of dynamodb to Throttled """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except DynamoDBError as error:
+            if error.kwargs.get('Code') in THROTTLING_CODES:
+                raise Throttled(str(error))
+            raise
+    return wrapper
+
+
+def create_table_if_missing(method):
+    """
+    Decorator creating the table when a request fails because it does not exist. The request is then sent again.
+    The indexes missing on a table created by an older version are not created here: dynamodb takes a while to build
+    them, so the migrate command of the CLI adds them.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except DynamoDBError as error:
+            if error.kwargs.get('Code') != 'ResourceNotFoundException' or missing_index(error):
+                raise
+            log.info('The table does not exist, creating it')
+            self.create_table()
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def missing_index(error):
+    """
+    Whether a request failed because its index is missing on the table, or is still being built.
+    Some implementations of the API report a missing index as a missing resource.
+    """
+    return error.kwargs.get('Code') in ('ValidationException', 'ResourceNotFoundException') and \
+        'index' in error.kwargs.get('Message', '').lower()
+
+
+def filter_expression(filters):
+    """
+    Build the filter expression matching field values, None matching the items where the field is not set
+    :return: the expression, or None without filters, its attribute names and its values
+    """
+    conditions = []
+    alias = {}
+    values = {}
+    for key, value in sorted(filters.items()):
+        alias['#' + key] = key
+        if value is None:
+            conditions.append('attribute_not_exists(#{key})'.format(key=key))
+        else:
+            conditions.append('#{key} = :{key}'.format(key=key))
+            values[key] = Approval.meta_.fields[key].ddb_dump(value)
+    return ' AND '.join(conditions) or None, alias, values
+
+
+def put_condition(expected):
+    """
+    Build the condition of the write of a lock read at a revision
+    :param expected: the revision of the lock when it was read, None if it did not exist
+    :return: the condition expression, its attribute names and its values
+    """
+    if expected is None:
+        return 'attribute_not_exists(#id)', {'#id': 'id'}, {}
+    if expected == 0:
+        # Items written by older versions of the resource have no revision
+        return 'attribute_exists(#id) AND attribute_not_exists(#revision)', {'#id': 'id', '#revision': 'revision'}, {}
+    return '#revision = :revision', {'#revision': 'revision'}, {'revision': expected}
+
+
+def to_lock(approval):
+    """ Convert a dynamodb item to a Lock """
+    if approval is None:
+        return None
+    lock = Lock(**dict((key, getattr(approval, key)) for key in approval.keys_()))
+    # Items written by older versions of the resource have no revision
+    if lock.revision is None:
+        lock.revision = 0
+    if lock.queue is not None:
+        lock.queue = json.loads(lock.queue)
+    return lock
+
+
+def to_approval(lock):
+    """ Convert a Lock to a dynamodb item """
+    fields = lock.to_dict()
+    if fields['queue'] is not None:
+        fields['queue'] = json.dumps(fields['queue'])
+    return Approval(**fields)
+
+
+class DynamoStorage(Storage):
+    """
+        Store the locks in the concourse-approval dynamodb table.
+        Locks are stored under their deterministic id. Locks created before the ids were deterministic are moved to
+        their deterministic id the first time a lock of their pool is missing, then the marker of the pool records
+        that it was migrated, so the pool partition is only queried once.
+        The partition of a pool also holds its marker item, skipped when the locks are listed.
+        The table is assumed to exist: it is only created when a request fails because it is missing.
+    """
+
+    def __init__(self, region, legacy_lookup=True, access_key=None, secret_key=None):
+        self.legacy_lookup = legacy_lookup
+        # Pools whose marker records that they were migrated
+        self.migrated_pools = set()
+        # Configure the connection to Dynamodb, the credentials are read from the environment if not given
+        self.session = botocore.session.get_session()
+        if access_key is not None:
+            self.session.set_credentials(access_key, secret_key)
+        client = self.session.create_client('dynamodb', region, config=CLIENT_CONFIG)
+        self.engine = Engine(dynamo=DynamoDBConnection(client))
+        self.engine.dynamo.request_retries = THROTTLE_RETRIES
+        # Register our model with the engine so it can create the Dynamo table
+        self.engine.register(Approval)
+
+    def schema_marker(self):
+        """ The file recording that the schema of the table was verified for this region """
+        return os.path.join(tempfile.gettempdir(), 'concourse-approval-schema-{region}-{table}-v{version}'.format(
+            region=self.engine.dynamo.region,
+            table=Approval.meta_.ddb_tablename(self.engine.namespace),
+            version=SCHEMA_VERSION))
+
+    def create_schema(self, force=False):
+        """
+        Create the table and its indexes. The verification costs several control plane requests,
+        so it is only done once per table and region, unless forced.
+        """
+        marker = self.schema_marker()
+        if not force and os.path.exists(marker):
+            return
+        self.create_table()
+        self.create_missing_indexes()
+        try:
+            open(marker, 'w').close()
+        except OSError as error:
+            log.debug('Unable to cache the schema verification: %s' % error)
+
+    def create_table(self):
+        """ Create the table of our registered model with its indexes, if it doesn't exist """
+        self.engine.create_schema()
+        self.enable_ttl()
+
+    def create_missing_indexes(self):
+        """
+        Add the indexes missing on a table created by an older version. dynamodb only creates one index per update of
+        a table, so they are created one after the other, each once the previous one is active.
+        :return: the names of the created indexes
+        """
+        tablename = Approval.meta_.ddb_tablename(self.engine.namespace)
+        existing = set(index['IndexName'] for index in self.describe_indexes(tablename))
+        created = []
+        for global_index in Approval.meta_.global_indexes:
+            if global_index.name in existing:
+                continue
+            log.info('Creating the index %s of the table %s' % (global_index.name, tablename))
+            self.engine.dynamo.update_table(tablename, index_updates=[
+                IndexUpdate.create(global_index.get_ddb_index(Approval.meta_.fields))])
+            self.wait_index_active(tablename, global_index.name)
+            created.append(global_index.name)
+        return created
+
+    def wait_index_active(self, tablename, name):
+        """ Block until dynamodb has built an index and it can be queried """
+        while True:
+            statuses = dict((index['IndexName'], index.get('IndexStatus'))
+                            for index in self.describe_indexes(tablename))
+            if statuses.get(name) == 'ACTIVE':
+                return
+            log.info('The index %s is %s, waiting' % (name, (statuses.get(name) or 'MISSING').lower()))
+            time.sleep(INDEX_POLL_INTERVAL)
+
+    def describe_indexes(self, tablename):
+        """ The descriptions of the global indexes of a table """
+        return self.engine.dynamo.client.describe_table(TableName=tablename)['Table'].get('GlobalSecondaryIndexes', [])
+
+    def enable_ttl(self):
+        """ Let dynamodb delete the items once their expires time is over """
+        client = self.engine.dynamo.client
+        tablename = Approval.meta_.ddb_tablename(self.engine.namespace)
+        description = client.describe_time_to_live(TableName=tablename)['TimeToLiveDescription']
+        if description.get('TimeToLiveStatus') in ('ENABLED', 'ENABLING'):
+            return
+        log.info('Enabling the time to live of the table %s' % tablename)
+        client.update_time_to_live(TableName=tablename, TimeToLiveSpecification={
+            'Enabled': True,
+            'AttributeName': 'expires',
+        })
+
+    @create_table_if_missing
+    @raise_throttled
+    def delete_lock(self, lock):
+        condition, alias, values = put_condition(lock.revision)
+        try:
+            self.engine.dynamo.delete_item2(Approval.meta_.ddb_tablename(self.engine.namespace),
+                                            {'pool': lock.pool, 'id': lock.id},
+                                            alias=alias, condition=condition, **values)
+        except CheckFailed:
+            raise LockConflict('The lock %s changed since revision %s' % (lock.lockname, lock.revision))
+
+    @create_table_if_missing
+    @raise_throttled
+    def record_compacted(self, pool, revision):
+        try:
+            self.engine.dynamo.update_item2(
+                Approval.meta_.ddb_tablename(self.engine.namespace), {'pool': pool, 'id': MARKER_ID},
+                'SET #compacted = :compacted', alias={'#compacted': 'compacted_revision'},
+                condition='attribute_not_exists(#compacted) OR #compacted < :compacted', compacted=revision)
+        except CheckFailed:
+            # A later revision was already compacted
+            pass
+
+    @create_table_if_missing
+    @raise_throttled
+    def compacted_revision(self, pool):
+        item = self.engine.dynamo.get_item2(Approval.meta_.ddb_tablename(self.engine.namespace),
+                                            {'pool': pool, 'id': MARKER_ID}, attributes=['compacted_revision'],
+                                            consistent=True)
+        return int(item.get('compacted_revision', 0)) if item else 0
+
+    @raise_throttled
+    def archive_locks(self, locks, table=ARCHIVE_TABLE):
+        items = []
+        for lock in locks:
+            approval = to_approval(lock)
+            approval.pre_save_(self.engine)
+            item = approval.ddb_dump_()
+            item['archive_id'] = archive_id(lock)
+            items.append(item)
+        try:
+            self.write_archive(table, items)
+        except DynamoDBError as error:
+            if error.kwargs.get('Code') != 'ResourceNotFoundException' or missing_index(error):
+                raise
+            log.info('The archive table %s does not exist, creating it' % table)
+            self.engine.dynamo.create_table(table, hash_key=DynamoKey('pool'), range_key=DynamoKey('archive_id'),
+                                            throughput=Throughput(read=1, write=1), wait=True)
+            self.write_archive(table, items)
+
+    def write_archive(self, table, items):
+        """ Write items to the archive table, in batches """
+        with self.engine.dynamo.batch_write(table) as batch:
+            for item in items:
+                batch.put(item)
+
+    def report_to(self, stats):
+        connection = self.engine.dynamo
+        connection.default_return_capacity = True
+
+        def consumed(connection, command, kwargs, response, capacity):
+            stats.consumed(capacity.total.read, capacity.total.write)
+        connection.subscribe('capacity', consumed)
+
+        # Calls of the client made by the current dynamo3 request, which sends a throttled call again as a new one
+        calls = [0]
+
+        def started(connection, command, kwargs):
+            calls[0] = 0
+        connection.subscribe('precall', started)
+
+        # The client retries the throttled requests before returning, each response tells how many times
+        def retried(parsed, **kwargs):
+            stats.retried(parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+            calls[0] += 1
+            if parsed.get('Error', {}).get('Code') == 'ProvisionedThroughputExceededException' and \
+                    calls[0] <= connection.request_retries:
+                stats.retried()
+        connection.client.meta.events.register('after-call.dynamodb', retried)
+
+    @create_table_if_missing
+    @raise_throttled
+    def get_lock(self, pool, lockname):
+        approval = self.engine.get(Approval, pool=pool, id=lock_id(pool, lockname), consistent=True)
+        if approval is None and self.legacy_lookup and self.migrate_pool(pool):
+            approval = self.engine.get(Approval, pool=pool, id=lock_id(pool, lockname), consistent=True)
+        return to_lock(approval)
+
+    @create_table_if_missing
+    @raise_throttled
+    def get_lock_by_id(self, id, pool=None):
+        if pool is None:
+            keys = self.engine.query(Approval) \
+                .index('id-index') \
+                .filter(id=id) \
+                .all(attributes=['pool', 'id'])
+            if not keys:
+                return None
+            pool = keys[0]['pool']
+        return to_lock(self.engine.get(Approval, pool=pool, id=id, consistent=True))
+
+    @create_table_if_missing
+    @raise_throttled
+    def get_locks(self, pool, locknames):
+        ids = [lock_id(pool, lockname) for lockname in locknames]
+        approvals = dict((approval.id, approval) for approval in self.engine.get(
+            Approval, [{'pool': pool, 'id': id} for id in ids], consistent=True))
+        locks = []
+        for id, lockname in zip(ids, locknames):
+            if id in approvals:
+                locks.append(to_lock(approvals[id]))
+            elif self.legacy_lookup:
+                locks.append(self.get_lock(pool, lockname))
+            else:
+                locks.append(None)
+        return locks
+
+    @create_table_if_missing
+    @raise_throttled
+    def save_lock(self, lock):
+        expected = lock.revision
+        condition, alias, values = put_condition(expected)
+        approval = to_approval(lock)
+        approval.revision = (self.compacted_revision(lock.pool) if expected is None else expected) + 1
+        if approval.expires is not None:
+            # dynamodb deletes the lock once it expires, a lock created again must start after its revision
+            self.record_compacted(lock.pool, approval.revision)
+        approval.pre_save_(self.engine)
+        try:
+            self.engine.dynamo.put_item2(Approval.meta_.ddb_tablename(self.engine.namespace), approval.ddb_dump_(),
+                                         alias=alias, condition=condition, **values)
+        except CheckFailed:
+            raise LockConflict('The lock %s changed since revision %s' % (lock.lockname, expected))
+        lock.revision = approval.revision
+
+    @create_table_if_missing
+    @raise_throttled
+    def save_locks(self, locks):
+        dynamizer = self.engine.dynamo.dynamizer
+        items = []
+        revisions = []
+        # Highest revision of the locks saved with an expiry, by pool
+        expiring = {}
+        for lock in locks:
+            condition, alias, values = put_condition(lock.revision)
+            approval = to_approval(lock)
+            approval.revision = (self.compacted_revision(lock.pool) if lock.revision is None else lock.revision) + 1
+            revisions.append(approval.revision)
+            if approval.expires is not None:
+                expiring[lock.pool] = max(expiring.get(lock.pool, 0), approval.revision)
+            approval.pre_save_(self.engine)
+            put = {
+                'TableName': Approval.meta_.ddb_tablename(self.engine.namespace),
+                'Item': dynamizer.encode_keys(approval.ddb_dump_()),
+                'ConditionExpression': condition,
+                'ExpressionAttributeNames': alias,
+            }
+            if values:
+                put['ExpressionAttributeValues'] = dynamizer.encode_keys(
+                    dict((':' + key, value) for key, value in values.items()))
+            items.append({'Put': put})
+        # dynamodb deletes the locks once they expire, the locks created again must start after their revisions
+        for pool, revision in expiring.items():
+            self.record_compacted(pool, revision)
+        try:
+            self.engine.dynamo.call('transact_write_items', TransactItems=items,
+                                    ReturnConsumedCapacity='INDEXES' if self.engine.dynamo.default_return_capacity
+                                    else 'NONE')
+        except DynamoDBError as error:
+            # The reasons of a cancelled transaction are listed in its message, in the order of the items
+            message = error.kwargs.get('Message', '')
+            code = error.kwargs.get('Code')
+            if code == 'TransactionInProgressException':
+                raise LockConflict('A transaction on the locks %s is in progress' %
+                                   ', '.join(lock.lockname for lock in locks))
+            if code != 'TransactionCanceledException':
+                raise
+            if 'ConditionalCheckFailed' in message:
+                raise LockConflict('One of the locks %s changed since it was read' %
+                                   ', '.join(lock.lockname for lock in locks))
+            # A concurrent transaction on one of the locks, the locks are read again like after a lost write
+            if 'TransactionConflict' in message:
+                raise LockConflict('One of the locks %s is written by a concurrent transaction' %
+                                   ', '.join(lock.lockname for lock in locks))
+            if 'ThrottlingError' in message or 'ProvisionedThroughputExceeded' in message:
+                raise Throttled(message)
+            raise
+        for lock, revision in zip(locks, revisions):
+            lock.revision = revision
+
+    @create_table_if_missing
+    @raise_throttled
+    def query_since(self, pool, since, limit, inclusive=False):
+        if inclusive:
+            condition = Approval.timestamp >= since
+        else:
+            condition = Approval.timestamp > since
+        try:
+            approvals = self.engine.query(Approval) \
+                .index('ts-index') \
+                .filter(condition, pool=pool) \
+                .limit(limit) \
+                .all()
+        except DynamoDBError as error:
+            if not missing_index(error):
+                raise
+            log.warning('The ts-index of the table is missing or being built, reading the whole pool. '
+                        'Run "python3 cli.py migrate" to create it')
+            locks = sorted((lock for lock in self.query_pool(pool)
+                            if (lock.timestamp >= since if inclusive else lock.timestamp > since)),
+                           key=lambda lock: lock.timestamp)
+            return locks[:limit]
+        return [to_lock(approval) for approval in approvals]
+
+    def query_before(self, pool, before, **filters):
+        condition, alias, values = filter_expression(filters)
+        alias.update({'#pool': 'pool', '#timestamp': 'timestamp'})
+        values.update(pool=pool, before=Approval.meta_.fields['timestamp'].ddb_dump(before))
+        items = self.engine.dynamo.query2(Approval.meta_.ddb_tablename(self.engine.namespace),
+                                          '#pool = :pool AND #timestamp < :before', index='ts-index',
+                                          alias=alias, filter=condition, **values)
+        try:
+            for item in items:
+                if item['id'] != MARKER_ID:
+                    yield to_lock(Approval.ddb_load_(self.engine, item))
+        except DynamoDBError as error:
+            if not missing_index(error):
+                raise
+            log.warning('The ts-index of the table is missing or being built, reading the whole pool. '
+                        'Run "python3 cli.py migrate" to create it')
+            yield from sorted((lock for lock in self.query_pool(pool, **filters) if lock.timestamp < before),
+                              key=lambda lock: lock.timestamp)
+
+    def query_pool(self, pool, **filters):
+        condition, alias, values = filter_expression(filters)
+        alias['#pool'] = 'pool'
+        values['pool'] = pool
+        items = self.engine.dynamo.query2(Approval.meta_.ddb_tablename(self.engine.namespace), '#pool = :pool',
+                                          alias=alias, filter=condition, **values)
+        for item in items:
+            if item['id'] != MARKER_ID:
+                yield to_lock(Approval.ddb_load_(self.engine, item))
+
+    @create_table_if_missing
+    @raise_throttled
+    def touch_pool(self, pool, modified):
+        tablename = Approval.meta_.ddb_tablename(self.engine.namespace)
+        key = {'pool': pool, 'id': MARKER_ID}
+        try:
+            self.engine.dynamo.update_item2(
+                tablename, key, 'ADD #revision :one SET #modified = :modified',
+                alias={'#revision': 'revision', '#modified': 'modified'},
+                condition='attribute_not_exists(#modified) OR #modified < :modified',
+                one=1, modified=modified.isoformat(' ', timespec='microseconds'))
+        except CheckFailed:
+            # A concurrent writer already recorded a later modification, only the revision is bumped
+            self.engine.dynamo.update_item2(tablename, key, 'ADD #revision :one', alias={'#revision': 'revision'},
+                                            one=1)
+
+    @create_table_if_missing
+    @raise_throttled
+    def get_pool_marker(self, pool):
+        item = self.engine.dynamo.get_item2(Approval.meta_.ddb_tablename(self.engine.namespace),
+                                            {'pool': pool, 'id': MARKER_ID}, consistent=True)
+        # The marker of a migrated pool exists before any lock of the pool changed
+        if not item or 'modified' not in item:
+            return None
+        return PoolMarker(pool, int(item['revision']), datetime.fromisoformat(item['modified']))
+
+    def change_feed(self):
+        # The stream of the table is enabled the first time a feed is needed
+        from changefeed import StreamFeed
+
+        client = self.engine.dynamo.client
+        tablename = Approval.meta_.ddb_tablename(self.engine.namespace)
+        table = client.describe_table(TableName=tablename)['Table']
+        specification = table.get('StreamSpecification', {})
+        if not specification.get('StreamEnabled'):
+            log.info('Enabling the stream of the table %s' % tablename)
+            table = client.update_table(TableName=tablename, StreamSpecification={
+                'StreamEnabled': True,
+                'StreamViewType': 'NEW_AND_OLD_IMAGES',
+            })['TableDescription']
+        elif specification.get('StreamViewType') != 'NEW_AND_OLD_IMAGES':
+            log.warning('The stream of the table %s does not have the old and new images' % tablename)
+            return None
+        streams = self.session.create_client('dynamodbstreams', client.meta.region_name, config=CLIENT_CONFIG)
+        return StreamFeed(streams, table['LatestStreamArn'])
+
+    def scan_locks(self, segment=0, total_segments=1, **filters):
+        condition, alias, values = filter_expression(filters)
+        items = self.engine.dynamo.scan2(Approval.meta_.ddb_tablename(self.engine.namespace),
+                                         alias=alias or None, filter=condition or False,
+                                         segment=segment, total_segments=total_segments, **values)
+        for item in items:
+            if item['id'] != MARKER_ID:
+                yield to_lock(Approval.ddb_load_(self.engine, item))
+
+    def migrate(self):
+        # The most recent item of a lock is migrated first, older duplicates are then dropped.
+        self.create_missing_indexes()
+        approvals = [approval for approval in self.engine.scan(Approval) if approval.id != MARKER_ID]
+        legacy_approvals = [approval for approval in approvals
+                            if approval.id != lock_id(approval.pool, approval.lockname)]
+        legacy_approvals.sort(key=lambda approval: approval.timestamp, reverse=True)
+        for approval in legacy_approvals:
+            self.rekey(approval)
+        for pool in set(approval.pool for approval in approvals):
+            self.mark_migrated(pool)
+        return len(legacy_approvals)
+
+    @create_table_if_missing
+    @raise_throttled
+    def migrate_pool(self, pool):
+        """
+            Move the locks of a pool created with a random id to their deterministic id, unless the marker of the
+            pool records that it was already migrated
+            :return: the number of migrated locks
+        """
+        if pool in self.migrated_pools:
+            return 0
+        tablename = Approval.meta_.ddb_tablename(self.engine.namespace)
+        marker = self.engine.dynamo.get_item2(tablename, {'pool': pool, 'id': MARKER_ID}, attributes=['migrated'],
+                                              consistent=True)
+        if marker and marker.get('migrated'):
+            self.migrated_pools.add(pool)
+            return 0
+        legacy_approvals = [Approval.ddb_load_(self.engine, item)
+                            for item in self.engine.dynamo.query2(tablename, '#pool = :pool', alias={'#pool': 'pool'},
+                                                                  pool=pool)
+                            if item['id'] not in (MARKER_ID, lock_id(pool, item.get('lockname')))]
+        legacy_approvals.sort(key=lambda approval: approval.timestamp, reverse=True)
+        for approval in legacy_approvals:
+            self.rekey(approval)
+        self.mark_migrated(pool)
+        return len(legacy_approvals)
+
+    def mark_migrated(self, pool):
+        """ Record on the marker of a pool that none of its locks has a random id anymore """
+        self.engine.dynamo.update_item2(Approval.meta_.ddb_tablename(self.engine.namespace),
+                                        {'pool': pool, 'id': MARKER_ID}, 'SET #migrated = :migrated',
+                                        alias={'#migrated': 'migrated'}, migrated=True)
+        self.migrated_pools.add(pool)
+
+    def rekey(self, legacy_approval):
+        """
+            Move a lock created with a random id to its deterministic id.
+            The copy is saved first so a concurrent migration can't lose the lock, then the legacy item is deleted.
+            :param legacy_approval: the approval item stored under a random id
+            :return: the approval item stored under its deterministic id
+        """
+        new_id = lock_id(legacy_approval.pool, legacy_approval.lockname)
+        if legacy_approval.id == new_id:
+            return legacy_approval
+        fields = dict((key, getattr(legacy_approval, key)) for key in legacy_approval.keys_())
+        fields['id'] = new_id
+        approval = Approval(**fields)
+        try:
+            self.engine.save(approval, overwrite=False)
+        except CheckFailed:
+            # Someone else already migrated it, the keyed item wins
+            approval = self.engine.get(Approval, pool=legacy_approval.pool, id=new_id, consistent=True)
+        self.engine.delete_key(Approval, pool=legacy_approval.pool, id=legacy_approval.id)
+        log.debug('Lock %s moved from id %s to id %s' % (legacy_approval.lockname, legacy_approval.id, new_id))
+        return approval
@@ -0,0 +1,113 @@
+"""
+    Logging of the resource commands.
+    The info messages go to stderr, where Concourse shows them. The debug records are kept in memory, in a ring
+    buffer, and only written to stderr when the command fails, so a successful command writes no file and formats
+    no debug message. With the debug parameter, all the records go to stderr right away.
+    The secrets of the source are masked in every record written.
+"""
+
+import collections
+import logging
+import sys
+
+# Fields of the source holding secrets
+SECRET_FIELDS = ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN')
+
+# Number of debug records kept in memory, the older ones are dropped
+BUFFER_SIZE = 500
+
+# Libraries logging every request at the debug level, only kept with the debug parameter
+VERBOSE_LOGGERS = ('boto3', 'botocore', 'urllib3')
+
+MASK = '***'
+
+
+def redact(data):
+    """ Copy the source or input of a command, with the secret fields masked """
+    if isinstance(data, dict):
+        return dict((key, MASK if key in SECRET_FIELDS and value else redact(value)) for key, value in data.items())
+    return data
+
+
+class Redactor(logging.Filter):
+    """
+        Mask the values of the secrets in the messages of the records
+    """
+
+    def __init__(self, secrets):
+        super().__init__()
+        self.secrets = [secret for secret in secrets if secret]
+
+    def filter(self, record):
+        if self.secrets:
+            message = record.getMessage()
+            for secret in self.secrets:
+                message = message.replace(secret, MASK)
+            record.msg = message
+            record.args = None
+        return True
+
+
+class RingBufferHandler(logging.Handler):
+    """
+        Keep the last debug records in memory, until they are dumped to a target handler.
+        The records are only formatted by the target, when they are dumped.
+    """
+
+    def __init__(self, target, capacity=BUFFER_SIZE):
+        super().__init__(level=logging.DEBUG)
+        self.target = target
+        self.records = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        # The records of the level of the target are already written
+        if record.levelno < self.target.level:
+            self.records.append(record)
+
+    def dump(self):
+        """ Write the records kept to the target, oldest first """
+        records, self.records = list(self.records), collections.deque(maxlen=self.records.maxlen)
+        if not records:
+            return
+        self.target.stream.write('Debug log of the failed command:\n')
+        for record in records:
+            self.target.handle(record)
+
+
+class ResourceStreamHandler(logging.StreamHandler):
+    """
+        Stream handler installed by configure, so it can be replaced
+    """
+
+
+def configure(debug, secrets=()):
+    """
+    Configure the logging of a command. The handlers of a previous command of the same process are replaced.
+    :param debug: write the debug records to stderr right away
+    :param secrets: the values to mask in the records
+    :return: the RingBufferHandler keeping the debug records, None with debug
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, (RingBufferHandler, ResourceStreamHandler)):
+            root.removeHandler(handler)
+    root.setLevel(logging.DEBUG)
+    for name in VERBOSE_LOGGERS:
+        logging.getLogger(name).setLevel(logging.DEBUG if debug else logging.WARNING)
+
+    stderr = ResourceStreamHandler(sys.stderr)
+    stderr.addFilter(Redactor(secrets))
+    root.addHandler(stderr)
+    # The debug records are written with their level, unlike the info messages of a successful command
+    if debug:
+        stderr.setLevel(logging.DEBUG)
+        stderr.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+        return None
+    stderr.setLevel(logging.INFO)
+    dump = ResourceStreamHandler(sys.stderr)
+    dump.setLevel(logging.INFO)
+    dump.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+    dump.addFilter(Redactor(secrets))
+    buffer = RingBufferHandler(dump)
+    root.addHandler(buffer)
+    return buffer
@@ -0,0 +1,75 @@
+"""
+    Scheduling of the polls done by the wait loops of the resource
+"""
+
+import logging as log
+import random
+import time
+
+from storage import Throttled
+
+
+class Poller:
+    """
+        Adaptive polling interval.
+        The interval starts at min_interval and doubles after each poll, up to max_interval. It goes back to
+        min_interval when the observed state changes, since another change is likely to follow soon.
+        Each wait is jittered so the waiters of a pool don't poll in lockstep, and a throttled storage makes
+        the poller back off to max_interval.
+        The sleep function can return early, to poll again as soon as a change is notified.
+    """
+
+    def __init__(self, min_interval, max_interval, factor=2, jitter=0.5, sleep=time.sleep):
+        self.min_interval = min(min_interval, max_interval)
+        self.max_interval = max_interval
+        self.factor = factor
+        self.jitter = jitter
+        self.sleep = sleep
+        self.interval = self.min_interval
+        self.state = None
+
+    def observe(self, state):
+        """
+        Tell the poller about the state read by the last poll
+        :param state: any comparable value, like the revision of a lock
+        :return: True if the state changed since the previous poll
+        """
+        if state == self.state:
+            return False
+        self.state = state
+        self.interval = self.min_interval
+        return True
+
+    def throttled(self):
+        """ Back off to the maximum interval """
+        self.interval = self.max_interval
+
+    def next_delay(self):
+        """ The jittered delay of the next wait, between (1 - jitter) * interval and interval """
+        return self.interval * (1 - self.jitter * random.random())
+
+    def wait(self, limit=None, slowdown=1):
+        """
+        Sleep until the next poll and grow the interval
+        :param limit: the maximum time to sleep, in seconds, when something is due before the next poll
+        :param slowdown: factor applied to the delay, when nothing is expected before several intervals
+        """
+        delay = self.next_delay() * slowdown
+        if limit is not None:
+            delay = max(0, min(delay, limit))
+        self.sleep(delay)
+        self.interval = min(self.interval * self.factor, self.max_interval)
+
+    def poll(self, read):
+        """
+        Call read, waiting and trying again while the storage is throttled
+        :param read: function doing the storage requests of the poll
+        :return: the value returned by read
+        """
+        while True:
+            try:
+                return read()
+            except Throttled as error:
+                log.info("The storage is throttled, backing off: %s" % error)
+                self.throttled()
+                self.wait()
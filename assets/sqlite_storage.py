@@ -0,0 +1,355 @@
+"""
+    SQLite storage of the approval locks.
+    It runs the lock protocol without AWS: for benchmarks, load tests and small self-hosted installs
+    where all the workers share the database file.
+"""
+
+from datetime import datetime
+import json
+import sqlite3
+
+from storage import ARCHIVE_TABLE, Lock, LockConflict, PoolMarker, Storage, archive_id, lock_id
+
+BOOLEAN_FIELDS = ('approved', 'claimed', 'need_approval')
+DATETIME_FIELDS = ('lease_expires', 'timestamp')
+JSON_FIELDS = ('queue',)
+
+# Number of changes kept by the local stream
+STREAM_RETENTION = 10000
+
+# Columns of the changes and pools tables added since they were created
+CHANGES_FIELDS = ('old_holder', 'new_holder')
+POOLS_FIELDS = ('compacted_revision',)
+
+# Number of rows read at once by the queries iterating over many locks
+PAGE_SIZE = 100
+
+
+def where_clause(filters):
+    """ The conditions matching field values, None matching the rows where the field is not set """
+    return ' AND '.join(('{key} IS NULL' if value is None else '{key} = :{key}').format(key=key)
+                        for key, value in sorted(filters.items()))
+
+
+def to_row(lock):
+    """ Convert a Lock to the values of a row of the locks table """
+    row = lock.to_dict()
+    for key in DATETIME_FIELDS:
+        if row[key] is not None:
+            row[key] = row[key].isoformat(' ', timespec='microseconds')
+    for key in JSON_FIELDS:
+        if row[key] is not None:
+            row[key] = json.dumps(row[key])
+    return row
+
+
+def to_lock(row):
+    """ Convert a row of the locks table to a Lock """
+    if row is None:
+        return None
+    fields = dict(row)
+    for key in BOOLEAN_FIELDS:
+        if fields[key] is not None:
+            fields[key] = bool(fields[key])
+    for key in DATETIME_FIELDS:
+        if fields[key] is not None:
+            fields[key] = datetime.fromisoformat(fields[key])
+    for key in JSON_FIELDS:
+        if fields[key] is not None:
+            fields[key] = json.loads(fields[key])
+    return Lock(**fields)
+
+
+class SQLiteStorage(Storage):
+    """
+        Store the locks in a SQLite database.
+        Timestamps are stored as ISO 8601 strings so they sort in the same order as the datetimes.
+    """
+
+    def __init__(self, database=':memory:'):
+        self.database = database
+        # Autocommit, transactions are opened explicitly when several statements must be atomic
+        self.connection = sqlite3.connect(database, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        # Creating the missing tables only costs local statements, so it is done on every connection
+        self.create_schema()
+
+    def create_schema(self):
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS locks (
+                pool TEXT NOT NULL,
+                id TEXT NOT NULL,
+                lockname TEXT,
+                timestamp TEXT,
+                claimed INTEGER,
+                need_approval INTEGER,
+                approved INTEGER,
+                team TEXT,
+                pipeline TEXT,
+                description TEXT,
+                revision INTEGER NOT NULL,
+                rejection_ack INTEGER,
+                holder TEXT,
+                lease_expires TEXT,
+                expires INTEGER,
+                queue TEXT,
+                PRIMARY KEY (pool, id)
+            );
+            CREATE INDEX IF NOT EXISTS locks_ts_index ON locks (pool, timestamp);
+            CREATE INDEX IF NOT EXISTS locks_id_index ON locks (id);
+            CREATE TABLE IF NOT EXISTS pools (
+                pool TEXT NOT NULL PRIMARY KEY,
+                revision INTEGER NOT NULL,
+                modified TEXT NOT NULL,
+                compacted_revision INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                event TEXT NOT NULL,
+                pool TEXT NOT NULL,
+                id TEXT NOT NULL,
+                old_approved INTEGER,
+                old_claimed INTEGER,
+                new_approved INTEGER,
+                new_claimed INTEGER,
+                revision INTEGER,
+                old_holder TEXT,
+                new_holder TEXT
+            );
+        ''')
+        self.add_missing_columns('locks')
+        self.add_missing_columns('changes', CHANGES_FIELDS)
+        self.add_missing_columns('pools', POOLS_FIELDS)
+        # The triggers of the databases created before the holder was recorded are replaced
+        self.connection.executescript('''
+            DROP TRIGGER IF EXISTS locks_insert_stream;
+            DROP TRIGGER IF EXISTS locks_update_stream;
+            CREATE TRIGGER IF NOT EXISTS locks_insert_changes AFTER INSERT ON locks BEGIN
+                INSERT INTO changes (event, pool, id, new_approved, new_claimed, new_holder, revision)
+                VALUES ('INSERT', NEW.pool, NEW.id, NEW.approved, NEW.claimed, NEW.holder, NEW.revision);
+                DELETE FROM changes WHERE seq <= last_insert_rowid() - {retention};
+            END;
+            CREATE TRIGGER IF NOT EXISTS locks_update_changes AFTER UPDATE ON locks BEGIN
+                INSERT INTO changes (event, pool, id, old_approved, old_claimed, old_holder, new_approved, new_claimed,
+                                     new_holder, revision)
+                VALUES ('MODIFY', NEW.pool, NEW.id, OLD.approved, OLD.claimed, OLD.holder, NEW.approved, NEW.claimed,
+                        NEW.holder, NEW.revision);
+                DELETE FROM changes WHERE seq <= last_insert_rowid() - {retention};
+            END;
+        '''.format(retention=STREAM_RETENTION))
+
+    def add_missing_columns(self, table, fields=Lock.FIELDS):
+        """ Add the columns of the fields added since a table was created """
+        columns = set(row['name'] for row in self.connection.execute('PRAGMA table_info({table})'.format(table=table)))
+        for field in fields:
+            if field not in columns:
+                self.connection.execute('ALTER TABLE {table} ADD COLUMN {field}'.format(table=table, field=field))
+
+    def get_lock(self, pool, lockname):
+        row = self.connection.execute('SELECT * FROM locks WHERE pool = ? AND id = ?',
+                                      (pool, lock_id(pool, lockname))).fetchone()
+        return to_lock(row)
+
+    def get_lock_by_id(self, id, pool=None):
+        if pool is None:
+            row = self.connection.execute('SELECT * FROM locks WHERE id = ?', (id,)).fetchone()
+        else:
+            row = self.connection.execute('SELECT * FROM locks WHERE pool = ? AND id = ?', (pool, id)).fetchone()
+        return to_lock(row)
+
+    def save_lock(self, lock):
+        lock.revision = self.write_lock(lock)
+
+    def save_locks(self, locks):
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            revisions = [self.write_lock(lock) for lock in locks]
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+        for lock, revision in zip(locks, revisions):
+            lock.revision = revision
+
+    def write_lock(self, lock):
+        """
+        Write a lock if it wasn't changed since it was read
+        :return: the new revision of the lock
+        """
+        expected = lock.revision
+        row = to_row(lock)
+        row['revision'] = (self.compacted_revision(lock.pool) if expected is None else expected) + 1
+        if expected is None:
+            columns = ', '.join(Lock.FIELDS)
+            placeholders = ', '.join(':' + key for key in Lock.FIELDS)
+            try:
+                self.connection.execute('INSERT INTO locks ({columns}) VALUES ({placeholders})'.format(
+                    columns=columns, placeholders=placeholders), row)
+            except sqlite3.IntegrityError:
+                raise LockConflict('The lock %s already exists' % lock.lockname)
+        else:
+            row['expected'] = expected
+            assignments = ', '.join('{key} = :{key}'.format(key=key) for key in Lock.FIELDS)
+            cursor = self.connection.execute(
+                'UPDATE locks SET {assignments} WHERE pool = :pool AND id = :id AND revision = :expected'.format(
+                    assignments=assignments), row)
+            if cursor.rowcount != 1:
+                raise LockConflict('The lock %s changed since revision %s' % (lock.lockname, expected))
+        return row['revision']
+
+    def query_since(self, pool, since, limit, inclusive=False):
+        operator = '>=' if inclusive else '>'
+        rows = self.connection.execute(
+            'SELECT * FROM locks WHERE pool = ? AND timestamp {operator} ? ORDER BY timestamp LIMIT ?'.format(
+                operator=operator),
+            (pool, since.isoformat(' ', timespec='microseconds'), limit))
+        return [to_lock(row) for row in rows]
+
+    def query_before(self, pool, before, **filters):
+        # The rows are read page by page, so the locks can be deleted while they are iterated over
+        conditions = where_clause(filters)
+        filters.update(pool=pool, before=before.isoformat(' ', timespec='microseconds'), after='', after_rowid=0,
+                       limit=PAGE_SIZE)
+        query = 'SELECT rowid, * FROM locks WHERE pool = :pool AND timestamp < :before ' \
+                'AND (timestamp > :after OR (timestamp = :after AND rowid > :after_rowid))'
+        if conditions:
+            query += ' AND ' + conditions
+        # Several locks can have the same timestamp, the rowid orders them
+        query += ' ORDER BY timestamp, rowid LIMIT :limit'
+        while True:
+            rows = self.connection.execute(query, filters).fetchall()
+            for row in rows:
+                yield to_lock(row)
+            if len(rows) < PAGE_SIZE:
+                return
+            filters.update(after=rows[-1]['timestamp'], after_rowid=rows[-1]['rowid'])
+
+    def query_pool(self, pool, **filters):
+        filters['pool'] = pool
+        for row in self.connection.execute('SELECT * FROM locks WHERE ' + where_clause(filters), filters):
+            yield to_lock(row)
+
+    def delete_lock(self, lock):
+        cursor = self.connection.execute('DELETE FROM locks WHERE pool = ? AND id = ? AND revision = ?',
+                                         (lock.pool, lock.id, lock.revision))
+        if cursor.rowcount != 1:
+            raise LockConflict('The lock %s changed since revision %s' % (lock.lockname, lock.revision))
+
+    def record_compacted(self, pool, revision):
+        # The pool has no modification time until one of its locks is touched
+        self.connection.execute('''
+            INSERT INTO pools (pool, revision, modified, compacted_revision) VALUES (?, 0, '', ?)
+            ON CONFLICT (pool) DO UPDATE SET
+                compacted_revision = MAX(IFNULL(compacted_revision, 0), excluded.compacted_revision)
+        ''', (pool, revision))
+
+    def compacted_revision(self, pool):
+        row = self.connection.execute('SELECT compacted_revision FROM pools WHERE pool = ?', (pool,)).fetchone()
+        return (row['compacted_revision'] or 0) if row else 0
+
+    def archive_locks(self, locks, table=ARCHIVE_TABLE):
+        table = '"{table}"'.format(table=table.replace('"', '""'))
+        columns = ('archive_id',) + Lock.FIELDS
+        self.connection.execute('CREATE TABLE IF NOT EXISTS {table} (archive_id TEXT NOT NULL PRIMARY KEY, {fields})'
+                                .format(table=table, fields=', '.join(Lock.FIELDS)))
+        self.add_missing_columns(table)
+        rows = []
+        for lock in locks:
+            row = to_row(lock)
+            row['archive_id'] = archive_id(lock)
+            rows.append(row)
+        self.connection.executemany('INSERT OR REPLACE INTO {table} ({columns}) VALUES ({placeholders})'.format(
+            table=table, columns=', '.join(columns), placeholders=', '.join(':' + key for key in columns)), rows)
+
+    def touch_pool(self, pool, modified):
+        self.connection.execute('''
+            INSERT INTO pools (pool, revision, modified) VALUES (?, 1, ?)
+            ON CONFLICT (pool) DO UPDATE SET revision = revision + 1, modified = MAX(modified, excluded.modified)
+        ''', (pool, modified.isoformat(' ', timespec='microseconds')))
+
+    def get_pool_marker(self, pool):
+        row = self.connection.execute('SELECT * FROM pools WHERE pool = ?', (pool,)).fetchone()
+        if row is None or not row['modified']:
+            return None
+        return PoolMarker(row['pool'], row['revision'], datetime.fromisoformat(row['modified']))
+
+    def change_feed(self):
+        from changefeed import StreamFeed
+        return StreamFeed(LocalStream(self.connection), 'local')
+
+    def scan_locks(self, segment=0, total_segments=1, **filters):
+        # The segments split the rows on their rowid, like the hash of the key splits the items of dynamodb
+        conditions = where_clause(filters)
+        filters.update(segment=segment, total_segments=total_segments)
+        query = 'SELECT * FROM locks WHERE rowid % :total_segments = :segment'
+        if conditions:
+            query += ' AND ' + conditions
+        for row in self.connection.execute(query, filters):
+            yield to_lock(row)
+
+
+def encode(value):
+    """ Encode a value of the changes table in the dynamodb JSON format """
+    if value is None:
+        return {'NULL': True}
+    if isinstance(value, str):
+        return {'S': value}
+    return {'BOOL': bool(value)}
+
+
+class LocalStream:
+    """
+        Local stand-in of the DynamoDB Streams API, serving the changes recorded by the triggers of the locks table.
+        The stream has a single shard and the shard iterators are sequence numbers of the changes table.
+    """
+
+    SHARD_ID = 'shardId-local'
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def describe_stream(self, StreamArn, **kwargs):
+        return {
+            'StreamDescription': {
+                'StreamArn': StreamArn,
+                'Shards': [{'ShardId': self.SHARD_ID, 'SequenceNumberRange': {'StartingSequenceNumber': '0'}}],
+            }
+        }
+
+    def get_shard_iterator(self, StreamArn, ShardId, ShardIteratorType, SequenceNumber=None):
+        if ShardIteratorType == 'TRIM_HORIZON':
+            position = 0
+        elif ShardIteratorType == 'AFTER_SEQUENCE_NUMBER':
+            position = int(SequenceNumber)
+        else:
+            position = self.connection.execute('SELECT IFNULL(MAX(seq), 0) FROM changes').fetchone()[0]
+        return {'ShardIterator': str(position)}
+
+    def get_records(self, ShardIterator, Limit=1000):
+        position = int(ShardIterator)
+        records = []
+        for row in self.connection.execute('SELECT * FROM changes WHERE seq > ? ORDER BY seq LIMIT ?',
+                                           (position, Limit)):
+            position = row['seq']
+            change = {
+                'Keys': {'pool': {'S': row['pool']}, 'id': {'S': row['id']}},
+                'NewImage': {
+                    'pool': {'S': row['pool']},
+                    'id': {'S': row['id']},
+                    'approved': encode(row['new_approved']),
+                    'claimed': encode(row['new_claimed']),
+                    'holder': encode(row['new_holder']),
+                    'revision': {'N': str(row['revision'])},
+                },
+                'SequenceNumber': str(row['seq']),
+            }
+            if row['event'] == 'MODIFY':
+                change['OldImage'] = {
+                    'pool': {'S': row['pool']},
+                    'id': {'S': row['id']},
+                    'approved': encode(row['old_approved']),
+                    'claimed': encode(row['old_claimed']),
+                    'holder': encode(row['old_holder']),
+                }
+            records.append({'eventName': row['event'], 'dynamodb': change})
+        return {'Records': records, 'NextShardIterator': str(position)}
@@ -0,0 +1,130 @@
+"""
+    Statistics of the storage requests of a command of the resource.
+    The storage methods are timed and counted, with the capacity units consumed by their requests, the requests
+    retried after a throttling and the conditional writes lost to a concurrent write. The totals are added to the
+    metadata of the command, and can be sent to a local sink: a StatsD server or a file of JSON lines.
+"""
+
+from urllib.parse import urlparse
+import json
+import logging as log
+import socket
+import time
+
+from storage import LockConflict, Throttled
+
+# Storage methods used by the commands of the resource, each call sends one or a few requests
+STORAGE_METHODS = ('archive_locks', 'compacted_revision', 'delete_lock', 'get_lock', 'get_lock_by_id', 'get_locks',
+                   'get_pool_marker', 'query_since', 'record_compacted', 'save_lock', 'save_locks', 'touch_pool')
+
+# Prefix of the StatsD metrics
+STATSD_PREFIX = 'concourse.approval'
+
+
+class InvocationStats:
+    """
+        The storage requests of a command, aggregated
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        # Number of calls and total time in seconds, by storage method
+        self.methods = {}
+        self.read_units = 0.0
+        self.write_units = 0.0
+        self.retries = 0
+        self.throttles = 0
+        self.conflicts = 0
+        self.depth = 0
+
+    def instrument(self, storage):
+        """
+        Time the calls of the storage methods and subscribe to the capacity and retries of the backend
+        :return: the storage
+        """
+        for name in STORAGE_METHODS:
+            setattr(storage, name, self.timed(name, getattr(storage, name)))
+        storage.report_to(self)
+        return storage
+
+    def timed(self, name, method):
+        """ Wrap a storage method to record its calls """
+        def wrapper(*args, **kwargs):
+            # Only the outermost call is recorded, as a method can be built on the others
+            if self.depth:
+                return method(*args, **kwargs)
+            self.depth += 1
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            except Throttled:
+                self.throttles += 1
+                raise
+            except LockConflict:
+                self.conflicts += 1
+                raise
+            finally:
+                self.depth -= 1
+                calls = self.methods.setdefault(name, [0, 0.0])
+                calls[0] += 1
+                calls[1] += time.perf_counter() - start
+        return wrapper
+
+    def consumed(self, read_units, write_units):
+        """ Record the capacity units consumed by a request """
+        self.read_units += read_units
+        self.write_units += write_units
+
+    def retried(self, attempts=1):
+        """ Record the times a request was sent again by the backend after a throttling """
+        self.retries += attempts
+
+    def totals(self):
+        """ The totals of the command so far """
+        return {
+            'duration_ms': round((time.perf_counter() - self.start) * 1000, 1),
+            'requests': sum(calls for calls, _ in self.methods.values()),
+            'request_ms': round(sum(seconds for _, seconds in self.methods.values()) * 1000, 1),
+            'read_units': self.read_units,
+            'write_units': self.write_units,
+            'retries': self.retries,
+            'throttles': self.throttles,
+            'conflicts': self.conflicts,
+        }
+
+    def metadata(self):
+        """ The totals as metadata of the resource """
+        return [{'name': 'stats_' + key, 'value': value} for key, value in sorted(self.totals().items())]
+
+    def emit(self, sink, command, tags):
+        """
+        Send the statistics of the command to a sink
+        :param sink: statsd://host:port for a StatsD server, else the path of a file to append a JSON line to
+        :param command: the name of the command, check, in or out
+        :param tags: the pool, team and pipeline of the command
+        """
+        totals = self.totals()
+        methods = dict((name, {'calls': calls, 'ms': round(seconds * 1000, 1)})
+                       for name, (calls, seconds) in self.methods.items())
+        if sink.startswith('statsd://'):
+            address = urlparse(sink)
+            lines = statsd_lines(command, totals, methods, tags)
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as connection:
+                connection.sendto('\n'.join(lines).encode(), (address.hostname, address.port or 8125))
+        else:
+            with open(sink, 'a') as sink_file:
+                sink_file.write(json.dumps(dict(totals, command=command, methods=methods, **tags)) + '\n')
+        log.debug('Statistics of the command sent to %s' % sink)
+
+
+def statsd_lines(command, totals, methods, tags):
+    """ Format the statistics as StatsD lines, tagged in the DogStatsD format """
+    tags = ['%s:%s' % (key, value) for key, value in sorted(tags.items()) if value is not None]
+    suffix = '|#' + ','.join(tags) if tags else ''
+    prefix = '{prefix}.{command}'.format(prefix=STATSD_PREFIX, command=command)
+    lines = ['%s.duration:%s|ms%s' % (prefix, totals['duration_ms'], suffix)]
+    for key in ('requests', 'read_units', 'write_units', 'retries', 'throttles', 'conflicts'):
+        lines.append('%s.%s:%s|c%s' % (prefix, key, totals[key], suffix))
+    for name, calls in sorted(methods.items()):
+        lines.append('%s.storage.%s:%s|ms%s' % (prefix, name, calls['ms'], suffix))
+    return lines
@@ -0,0 +1,295 @@
+"""
+    Storage of the approval locks.
+    The resource and the CLI only talk to a Storage. The backend is selected with the `backend` parameter of the
+    resource source: `dynamodb` (default) or `sqlite`, which runs the lock protocol without AWS.
+"""
+
+import logging as log
+import uuid
+
+# Namespace used to derive the deterministic id of a lock from its pool and name
+LOCK_NAMESPACE = uuid.UUID('5f1f3a4e-2c5b-4f0e-9d3c-6a1b7e2d8c40')
+
+# Default table of the compacted locks
+ARCHIVE_TABLE = 'concourse-approval-archive'
+
+
+def lock_id(pool, lockname):
+    """
+        Build the deterministic id of a lock.
+        As the id only depends on the pool and the lock name, a lock can be fetched with a single keyed read
+        instead of reading the whole pool.
+    """
+    return str(uuid.uuid5(LOCK_NAMESPACE, '{pool}/{lockname}'.format(pool=pool, lockname=lockname)))
+
+
+def archive_id(lock):
+    """ Build the key of the archived copy of a lock, unique for each of its lives """
+    return '{id}/{timestamp}'.format(id=lock.id, timestamp=lock.timestamp.isoformat(' ', timespec='microseconds'))
+
+
+class LockConflict(Exception):
+    """
+        Raised when a conditional write of a lock fails because the lock changed since it was read
+    """
+
+
+class Throttled(Exception):
+    """
+        Raised when the storage refuses a request because the provisioned throughput is exceeded
+    """
+
+
+class Lock:
+    """
+        An approval lock, independent of the storage backend.
+        A claim can be a lease: holder is the build holding it and lease_expires the time after which another
+        claimer can take it. expires is the time, in seconds since the epoch, after which dynamodb deletes the lock.
+        queue is the list of the builds waiting for the lock, first come first served: each ticket is a dict with
+        the holder of the waiting build and the time, in seconds since the epoch, its ticket expires.
+    """
+
+    FIELDS = ('approved', 'claimed', 'description', 'expires', 'holder', 'id', 'lease_expires', 'lockname',
+              'need_approval', 'pipeline', 'pool', 'queue', 'rejection_ack', 'revision', 'team', 'timestamp')
+    DEFAULTS = {
+        'need_approval': False,
+    }
+
+    def __init__(self, **kwargs):
+        for key in self.FIELDS:
+            setattr(self, key, kwargs.get(key, self.DEFAULTS.get(key)))
+
+    def keys_(self):
+        """ All the fields of the lock """
+        return self.FIELDS
+
+    def to_dict(self):
+        return dict((key, getattr(self, key)) for key in self.FIELDS)
+
+
+class PoolMarker:
+    """
+        The last modification of the locks of a pool.
+        revision counts the modifications, modified is the most recent timestamp of the modified locks.
+    """
+
+    def __init__(self, pool, revision, modified):
+        self.pool = pool
+        self.revision = revision
+        self.modified = modified
+
+
+class Storage:
+    """
+        Interface of the storage backends.
+        Timestamps are naive datetimes, like the ones returned by datetime.now().
+        Writes are conditional on the revision of the lock: the revision is a counter bumped by every write,
+        a lock which was never saved has no revision. It is also used as a fencing token by the lock holders.
+    """
+
+    def create_schema(self):
+        """
+        Create the tables and indexes needed by the locks if they don't exist yet.
+        The resource does not call it: the backends create their tables when they are missing.
+        """
+        raise NotImplementedError
+
+    def get_lock(self, pool, lockname):
+        """
+        Fetch a lock with a strongly consistent read
+        :return: the Lock or None if the lock does not exist
+        """
+        raise NotImplementedError
+
+    def get_lock_by_id(self, id, pool=None):
+        """
+        Fetch a lock from its id with a strongly consistent read. Without a pool, the pool of the lock is first
+        looked up in an index.
+        :return: the Lock or None if the lock does not exist
+        """
+        raise NotImplementedError
+
+    def save_lock(self, lock):
+        """
+        Save a lock if it wasn't changed since it was read, then bump its revision. A new lock starts after the
+        compacted revision of its pool.
+        :raise LockConflict: if the stored revision is not the revision of the lock
+        """
+        raise NotImplementedError
+
+    def update_lock(self, pool, lockname, update, current=None):
+        """
+        Read, modify and conditionally write a lock, the update is tried again when a concurrent write wins
+        :param update: function called with the current Lock or None if it does not exist. It returns the Lock
+        to save, or None to leave the lock untouched.
+        :param current: the lock if it was just read, to save the first read
+        :return: the saved Lock, or None if the update left the lock untouched
+        """
+        while True:
+            if current is None:
+                current = self.get_lock(pool, lockname)
+            lock = update(current)
+            current = None
+            if lock is None:
+                return None
+            try:
+                self.save_lock(lock)
+                return lock
+            except LockConflict:
+                log.debug('The lock %s changed concurrently, trying again' % lockname)
+
+    def get_locks(self, pool, locknames):
+        """
+        Fetch several locks of a pool with strongly consistent reads
+        :return: the list of Lock or None, in the order of the lock names
+        """
+        return [self.get_lock(pool, lockname) for lockname in locknames]
+
+    def save_locks(self, locks):
+        """
+        Save several locks in a single transaction, if none of them was changed since it was read: either all the
+        locks are saved and their revisions bumped, or none is
+        :raise LockConflict: if the stored revision of a lock is not its revision
+        """
+        raise NotImplementedError
+
+    def update_locks(self, pool, locknames, update):
+        """
+        Read, modify and conditionally write several locks of a pool all at once, the update is tried again when
+        a concurrent write wins
+        :param update: function called with the list of the current Lock or None, in the order of the lock names.
+        It returns the list of Lock to save, or None to leave the locks untouched.
+        :return: the saved locks, or None if the update left the locks untouched
+        """
+        while True:
+            locks = update(self.get_locks(pool, locknames))
+            if locks is None:
+                return None
+            try:
+                self.save_locks(locks)
+                return locks
+            except LockConflict:
+                log.debug('One of the locks %s changed concurrently, trying again' % ', '.join(locknames))
+
+    def query_since(self, pool, since, limit, inclusive=False):
+        """
+        Fetch the locks of a pool changed after a timestamp
+        :param since: the timestamp to start from
+        :param limit: the maximum number of locks to read
+        :param inclusive: if True, a lock with the exact timestamp is returned too
+        :return: the list of Lock ordered by timestamp
+        """
+        raise NotImplementedError
+
+    def query_before(self, pool, before, **filters):
+        """
+        Iterate over the locks of a pool changed before a timestamp, oldest first, read page by page
+        :param before: the timestamp the locks are older than
+        :param filters: field values the locks must match, None matching the locks where the field is not set
+        """
+        raise NotImplementedError
+
+    def query_pool(self, pool, **filters):
+        """
+        Iterate over the locks of a pool, read page by page
+        :param filters: field values the locks must match, None matching the locks where the field is not set
+        """
+        raise NotImplementedError
+
+    def scan_locks(self, segment=0, total_segments=1, **filters):
+        """
+        Iterate over all the locks, whatever their pool, read page by page.
+        The locks can be split in total_segments disjoint segments, read in parallel.
+        :param segment: the segment to read, from 0 to total_segments - 1
+        :param filters: field values the locks must match, None matching the locks where the field is not set
+        """
+        raise NotImplementedError
+
+    def touch_pool(self, pool, modified):
+        """
+        Record that a lock of the pool changed. It must be called once the lock is saved, so a lock is never
+        more recent than the marker.
+        The revision of the marker is bumped by every call, even when the timestamp is not newer than the modification
+        time of the marker, so the waiters watching the revision see every change. The modification time of the
+        marker never goes back.
+        :param modified: the timestamp of the saved lock
+        """
+        raise NotImplementedError
+
+    def get_pool_marker(self, pool):
+        """
+        Fetch the marker of a pool with a strongly consistent read
+        :return: the PoolMarker, or None if no lock of the pool changed since the markers exist
+        """
+        raise NotImplementedError
+
+    def change_feed(self):
+        """
+        Open a feed of the changes made to the locks
+        :return: a changefeed.StreamFeed, or None if the backend has no change feed
+        """
+        return None
+
+    def delete_lock(self, lock):
+        """
+        Delete a lock if it wasn't changed since it was read
+        :raise LockConflict: if the stored revision is not the revision of the lock
+        """
+        raise NotImplementedError
+
+    def record_compacted(self, pool, revision):
+        """
+        Record the revision of a lock about to be deleted from a pool, so a lock created again in the pool starts
+        after it and its revision never goes back. It must be called before the lock is deleted, or saved with an
+        expiry when the backend deletes the expired locks.
+        The compacted revision of the pool never goes back.
+        """
+        raise NotImplementedError
+
+    def compacted_revision(self, pool):
+        """
+        Fetch the highest revision of the locks deleted from a pool with a strongly consistent read
+        :return: the revision, 0 if no lock was deleted
+        """
+        raise NotImplementedError
+
+    def archive_locks(self, locks, table=ARCHIVE_TABLE):
+        """
+        Copy locks to an archive table, created if it does not exist. Each copy is keyed by the id and timestamp of
+        the lock, so the successive lives of a lock are kept side by side.
+        """
+        raise NotImplementedError
+
+    def report_to(self, stats):
+        """
+        Report the capacity consumed by the requests of the backend, and the requests it sends again after a
+        throttling, to the statistics of the command. The backends without capacity units report nothing.
+        :param stats: a stats.InvocationStats
+        """
+
+    def migrate(self):
+        """
+        Upgrade the data stored by older versions of the resource
+        :return: the number of migrated locks
+        """
+        return 0
+
+
+def get_storage(source):
+    """
+    Build the storage backend configured in the source of the resource.
+    The backend modules are only imported when they are used.
+    :param source: the source configuration of the resource
+    :return: a Storage
+    """
+    backend = source.get('backend', 'dynamodb')
+    if backend == 'dynamodb':
+        from dynamodb_storage import DynamoStorage
+        return DynamoStorage(region=source.get('AWS_DEFAULT_REGION', 'eu-west-1'),
+                             legacy_lookup=source.get('legacy_lookup', True),
+                             access_key=source.get('AWS_ACCESS_KEY_ID') or None,
+                             secret_key=source.get('AWS_SECRET_ACCESS_KEY') or None)
+    elif backend == 'sqlite':
+        from sqlite_storage import SQLiteStorage
+        return SQLiteStorage(database=source.get('database', ':memory:'))
+    raise ValueError('Unknown storage backend %s' % backend)
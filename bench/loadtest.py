@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+    Contention load test of the lock protocol.
+    Simulated pipelines claim a lock among a few shared ones, optionally wait for its approval, hold it and release
+    it, while a check polls the pool. Each command is a new process running the real ApprovalResource, like in
+    Concourse, and counts the storage requests it sends.
+
+    By default the pipelines share a sqlite database in a temporary directory:
+
+        python3 bench/loadtest.py --pipelines 20 --locks 2 --rounds 5 --approval-delay 1
+
+    The report gives the latency from the start of a claim to the lock being acquired, the latency from an approval
+    to the get noticing it, the reads and writes per command and the fairness of the wait times between pipelines.
+    Any source can be passed with --source, like a dynamodb one, to size wait_lock and the capacity of the table.
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'assets')
+sys.path.insert(0, ASSETS_DIR)
+
+from storage import get_storage  # noqa: E402
+
+# Resource command run for each step of a pipeline
+COMMANDS = {'claim': 'out', 'get': 'in', 'release': 'out', 'check': 'check'}
+
+# Storage methods sending read and write requests. The update methods are built on them.
+READS = ('get_lock', 'get_lock_by_id', 'get_locks', 'get_pool_marker', 'query_pool', 'query_since', 'scan_locks')
+WRITES = ('save_lock', 'save_locks', 'touch_pool')
+
+
+def worker(command, argument):
+    """
+    Run a resource command in this process, with the payload read from stdin, and print a JSON line with its
+    output, its duration and the number of storage requests it sent
+    """
+    import approval
+
+    counts = {'reads': 0, 'writes': 0}
+
+    def counted(method, kind):
+        def wrapper(*args, **kwargs):
+            counts[kind] += 1
+            return method(*args, **kwargs)
+        return wrapper
+
+    def counting_storage(source):
+        storage = get_storage(source)
+        # The wrappers are set on the instance, so the update methods of the class call them too
+        for name in READS:
+            setattr(storage, name, counted(getattr(storage, name), 'reads'))
+        for name in WRITES:
+            setattr(storage, name, counted(getattr(storage, name), 'writes'))
+        return storage
+
+    approval.get_storage = counting_storage
+    status = 0
+    output = None
+    start = time.perf_counter()
+    try:
+        output = json.loads(approval.ApprovalResource(command, sys.stdin.read(), [argument] if argument else []).run())
+    except SystemExit as error:
+        status = error.code or 0
+    elapsed = time.perf_counter() - start
+    print(json.dumps(dict(counts, status=status, output=output, elapsed=elapsed)))
+
+
+class LoadTest:
+    """
+        Run the simulated pipelines and collect the samples of each command
+    """
+
+    def __init__(self, source, work_dir, approval_delay, hold):
+        self.source = source
+        self.work_dir = work_dir
+        self.approval_delay = approval_delay
+        self.hold = hold
+        self.samples = dict((command, []) for command in ('claim', 'get', 'release', 'check'))
+        # Seconds from the start of each claim to the lock being acquired, by pipeline
+        self.waits = {}
+        self.notices = []
+        self.failures = []
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    def run_command(self, command, payload, env=None, argument=None):
+        """ Run a resource command in a new worker process and record its sample """
+        args = [sys.executable, os.path.abspath(__file__), 'worker', COMMANDS[command]]
+        if argument:
+            args.append(argument)
+        process = subprocess.run(args, input=json.dumps(payload).encode(), stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, env=dict(os.environ, **(env or {})))
+        result = json.loads(process.stdout.decode().splitlines()[-1]) if process.stdout else None
+        if result is None or result['status']:
+            with self.lock:
+                self.failures.append((command, process.stderr.decode()[-500:]))
+            return None
+        return result
+
+    def record(self, command, result):
+        with self.lock:
+            self.samples[command].append(result)
+
+    def approve(self, lock_name, holder, approved_at):
+        """ Approve the claim of a holder after the approval delay, like an operator with the CLI """
+        storage = get_storage(self.source)
+        time.sleep(self.approval_delay)
+
+        def approve(lock):
+            if not lock or not lock.claimed or lock.holder != holder:
+                return None
+            lock.approved = True
+            return lock
+
+        lock = storage.update_lock(self.source['pool'], lock_name, approve)
+        if lock:
+            approved_at.append(time.time())
+            storage.touch_pool(self.source['pool'], lock.timestamp)
+
+    def pipeline(self, index, lock_names, rounds):
+        """ Claim, get and release locks, one round after the other """
+        pipeline = 'pipeline-%s' % index
+        for round in range(rounds):
+            lock_name = random.choice(lock_names)
+            env = {'BUILD_ID': '%s-%s' % (index, round), 'BUILD_PIPELINE_NAME': pipeline}
+            target_dir = tempfile.mkdtemp(dir=self.work_dir)
+            params = {'lock_name': lock_name, 'action': 'claim'}
+            if self.approval_delay is not None:
+                params['need_approval'] = True
+            result = self.run_command('claim', {'source': self.source, 'params': params}, env, target_dir)
+            if result is None:
+                continue
+            self.record('claim', result)
+            with self.lock:
+                self.waits.setdefault(pipeline, []).append(result['elapsed'])
+
+            if self.approval_delay is not None:
+                approved_at = []
+                approver = threading.Thread(target=self.approve, args=(lock_name, env['BUILD_ID'], approved_at))
+                approver.start()
+                result = self.run_command('get', {'source': self.source, 'version': result['output']['version'],
+                                                  'params': {'lock_name': lock_name, 'need_approval': True}},
+                                          env, target_dir)
+                approver.join()
+                if result is not None:
+                    self.record('get', result)
+                    if approved_at:
+                        with self.lock:
+                            self.notices.append(time.time() - approved_at[0])
+
+            time.sleep(self.hold)
+            result = self.run_command('release', {'source': self.source,
+                                                  'params': {'lock_name': lock_name, 'action': 'release'}},
+                                      env, target_dir)
+            if result is not None:
+                self.record('release', result)
+
+    def checker(self, interval):
+        """ Poll the pool like the check of a pipeline using the resource as a trigger """
+        version = None
+        while not self.stopped.wait(interval):
+            result = self.run_command('check', {'source': self.source, 'version': version})
+            if result is not None:
+                self.record('check', result)
+                version = result['output'][-1]
+
+
+def percentile(samples, ratio):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(ratio * (len(ordered) - 1))))]
+
+
+def jain_index(values):
+    """ Jain's fairness index, 1 when all the values are equal, 1 / n when a single one gets everything """
+    if not values or not any(values):
+        return 1.0
+    return sum(values) ** 2 / (len(values) * sum(value ** 2 for value in values))
+
+
+def print_latencies(name, values):
+    if not values:
+        print('%-16s %8s' % (name, 'none'))
+        return
+    values = [value * 1000 for value in values]
+    print('%-16s %8d %10.1f %10.1f %10.1f %10.1f' % (name, len(values), percentile(values, 0.5),
+                                                     percentile(values, 0.95), percentile(values, 0.99),
+                                                     max(values)))
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == 'worker':
+        worker(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+        return
+
+    parser = argparse.ArgumentParser(description="Contention load test of the claims, gets and checks of a pool")
+    parser.add_argument("--pipelines", type=int, default=10, help="number of pipelines claiming the locks")
+    parser.add_argument("--locks", type=int, default=2, help="number of locks shared by the pipelines")
+    parser.add_argument("--rounds", type=int, default=3, help="number of claims of each pipeline")
+    parser.add_argument("--hold", type=float, default=0.5, help="seconds a lock is held before its release")
+    parser.add_argument("--approval-delay", type=float, default=None,
+                        help="seconds before each claim is approved, the claims don't need an approval by default")
+    parser.add_argument("--check-interval", type=float, default=1, help="seconds between two checks of the pool")
+    parser.add_argument("--source", default=None, help="JSON source of the resource, sqlite in a temporary "
+                                                       "directory by default")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the choice of the locks")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    work_dir = tempfile.mkdtemp(prefix='approval-loadtest')
+    if args.source:
+        source = json.loads(args.source)
+    else:
+        source = {'pool': 'loadtest', 'backend': 'sqlite', 'database': os.path.join(work_dir, 'approval.db'),
+                  'wait_lock': 2, 'wait_lock_min': 0.2}
+    load_test = LoadTest(source, work_dir, args.approval_delay, args.hold)
+    lock_names = ['lock-%s' % index for index in range(args.locks)]
+
+    start = time.time()
+    checker = threading.Thread(target=load_test.checker, args=(args.check_interval,), daemon=True)
+    checker.start()
+    pipelines = [threading.Thread(target=load_test.pipeline, args=(index, lock_names, args.rounds))
+                 for index in range(args.pipelines)]
+    for pipeline in pipelines:
+        pipeline.start()
+    for pipeline in pipelines:
+        pipeline.join()
+    load_test.stopped.set()
+    checker.join()
+    duration = time.time() - start
+
+    mean_waits = [statistics.mean(waits) for waits in load_test.waits.values()]
+    all_waits = [wait for waits in load_test.waits.values() for wait in waits]
+    report = {
+        'duration': duration,
+        'latencies': {
+            'claim_to_acquire': all_waits,
+            'approval_notice': load_test.notices,
+        },
+        'requests': dict((command, {
+            'count': len(samples),
+            'reads': statistics.mean(sample['reads'] for sample in samples) if samples else 0,
+            'writes': statistics.mean(sample['writes'] for sample in samples) if samples else 0,
+        }) for command, samples in load_test.samples.items()),
+        'fairness': {
+            'jain_index': jain_index(mean_waits),
+            'min_mean_wait': min(mean_waits) if mean_waits else 0,
+            'max_mean_wait': max(mean_waits) if mean_waits else 0,
+        },
+        'failures': len(load_test.failures),
+    }
+
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print('%d pipelines, %d locks, %d rounds in %.1f s' % (args.pipelines, args.locks, args.rounds, duration))
+        print()
+        print('%-16s %8s %10s %10s %10s %10s' % ('latency', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+        print_latencies('claim to acquire', all_waits)
+        print_latencies('approval notice', load_test.notices)
+        print()
+        print('%-16s %8s %10s %10s' % ('command', 'count', 'reads', 'writes'))
+        for command, requests in report['requests'].items():
+            print('%-16s %8d %10.1f %10.1f' % (command, requests['count'], requests['reads'], requests['writes']))
+        print()
+        print('fairness of the waits between pipelines: Jain index %.3f, mean wait from %.1f s to %.1f s' % (
+            report['fairness']['jain_index'], report['fairness']['min_mean_wait'],
+            report['fairness']['max_mean_wait']))
+    for command, error in load_test.failures:
+        print('%s failed: %s' % (command, error), file=sys.stderr)
+    if load_test.failures:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
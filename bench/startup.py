@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+    Startup benchmark of the resource.
+    Each resource command is a fresh process, so its startup is most of the cost of a check. This script times
+    check, in and out from the start of the process to its JSON output, and fails if the median of a command
+    goes over the budget.
+
+    By default the commands use the sqlite backend, so the numbers don't depend on the network:
+
+        python3 bench/startup.py --runs 20 --budget-ms 150
+
+    The sqlite commands never import flywheel, dynamo3 or botocore. So the script also times, offline, the startup of
+    each storage backend in a new process: its imports and the creation of its client, without any request. To
+    measure the commands against dynamodb, pass a source with the AWS credentials:
+
+        python3 bench/startup.py --source '{"pool": "bench", "AWS_ACCESS_KEY_ID": "...", ...}'
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'assets')
+
+# Code timed in a new process for the startup of each backend. The storage is built like the resource builds it,
+# the dynamodb client is created without sending any request. The interpreter alone is the baseline
+BACKEND_STARTUP = (
+    ('python', 'pass'),
+    ('sqlite', 'import storage; storage.get_storage({"backend": "sqlite"})'),
+    ('dynamodb', 'import storage; storage.get_storage({"backend": "dynamodb", "legacy_lookup": False})'),
+)
+
+
+def run_command(command, payload, target_dir):
+    """
+    Run a resource command in a new process
+    :return: the time in seconds from the start of the process to its JSON output
+    """
+    args = [sys.executable, os.path.join(ASSETS_DIR, command)]
+    if command != 'check':
+        args.append(target_dir)
+    start = time.perf_counter()
+    process = subprocess.run(args, input=json.dumps(payload).encode(), stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError('%s failed: %s' % (command, process.stderr.decode()))
+    json.loads(process.stdout.decode())
+    return elapsed
+
+
+def run_startup(code):
+    """
+    Run the startup code of a backend in a new process
+    :return: the time in seconds from the start of the process to its end
+    """
+    env = dict(os.environ, PYTHONPATH=ASSETS_DIR, AWS_DEFAULT_REGION='eu-west-1')
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    elapsed = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.decode().strip().splitlines()[-1])
+    return elapsed
+
+
+def print_row(name, samples):
+    """ Print the min, median, p95 and max of samples in seconds, in milliseconds """
+    values = [sample * 1000 for sample in samples]
+    print('%-8s %8.1f %8.1f %8.1f %8.1f' % (name, min(values), statistics.median(values), percentile(values, 0.95),
+                                             max(values)))
+
+
+def percentile(samples, ratio):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(ratio * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup benchmark of the check, in and out commands")
+    parser.add_argument("--runs", type=int, default=10, help="number of runs of each command")
+    parser.add_argument("--budget-ms", type=float, default=None,
+                        help="fail if the median time of a command is over this budget")
+    parser.add_argument("--source", default=None, help="JSON source of the resource, sqlite in a temporary "
+                                                       "directory by default")
+    parser.add_argument("--lock-name", default='startup-benchmark')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='approval-bench')
+    if args.source:
+        source = json.loads(args.source)
+    else:
+        source = {'pool': 'bench', 'backend': 'sqlite', 'database': os.path.join(work_dir, 'approval.db')}
+
+    claim = {'source': source, 'params': {'lock_name': args.lock_name, 'action': 'claim'}}
+    fetch = {'source': source, 'params': {'lock_name': args.lock_name}}
+    release = {'source': source, 'params': {'lock_name': args.lock_name, 'action': 'release'}}
+    check = {'source': source}
+
+    samples = {'check': [], 'in': [], 'out': []}
+    for _ in range(args.runs):
+        samples['out'].append(run_command('out', claim, work_dir))
+        samples['in'].append(run_command('in', fetch, work_dir))
+        samples['check'].append(run_command('check', check, work_dir))
+        samples['out'].append(run_command('out', release, work_dir))
+
+    over_budget = []
+    print('%-8s %8s %8s %8s %8s' % ('command', 'min ms', 'p50 ms', 'p95 ms', 'max ms'))
+    for command in ('check', 'in', 'out'):
+        print_row(command, samples[command])
+        if args.budget_ms is not None and statistics.median(samples[command]) * 1000 > args.budget_ms:
+            over_budget.append(command)
+
+    print()
+    print('%-8s %8s %8s %8s %8s' % ('backend', 'min ms', 'p50 ms', 'p95 ms', 'max ms'))
+    for backend, code in BACKEND_STARTUP:
+        try:
+            print_row(backend, [run_startup(code) for _ in range(args.runs)])
+        except RuntimeError as error:
+            print('%-8s %s' % (backend, error))
+
+    if over_budget:
+        print('Over the budget of %.1f ms: %s' % (args.budget_ms, ', '.join(over_budget)))
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,33 @@
 #!/usr/bin/env python
 
-from datetime import datetime
-from flywheel import Model, Field, Engine
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from tabulate import tabulate
-import sys, argparse, logging
-
-
-class Approval(Model):
-    __metadata__ = {
-        '_name': 'concourse-approval',
-        '_ordering': 'ts-index',
-        'throughput': {
-            'read': 1,
-            'write': 1,
-        }
-    }
-    id = Field(type=str, range_key=True)
-    lockname = Field()
-    pool = Field(hash_key=True)
-    timestamp = Field(type=datetime, index='ts-index')
-    claimed = Field(type=bool)
-    need_approval = Field(type=bool, default=False)
-    approved = Field(type=bool, nullable=True)
-    team = Field()
-    pipeline = Field()
-    description = Field(type=str, nullable=True)
+import os, sys, argparse, json, logging, queue, threading
+
+# The storage is shared with the resource
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets'))
+from compaction import FileArchive, TableArchive, compact
+from storage import ARCHIVE_TABLE, Lock, get_storage
+
+# Values of the filters of the list action
+FILTER_VALUES = {
+    'true': True,
+    'false': False,
+    'none': None,
+}
 
 
 class CLI():
     def __init__(self, args):
-        self.engine = Engine()
-        self.engine.connect_to_region('eu-west-1')
-
-        # Register our model with the engine so it can create the Dynamo table
-        self.engine.register(Approval)
+        self.storage = get_storage({
+            'backend': args.backend,
+            'database': args.database,
+            'AWS_DEFAULT_REGION': args.region,
+        })
 
-        # Create the dynamo table for our registered model
-        self.engine.create_schema()
+        # Create the tables of the storage if they don't exist yet
+        self.storage.create_schema()
         self.args = args
         # Setup logging
         if args.verbose:
@@ -52,64 +43,207 @@ class CLI():
             self.approve()
         elif self.args.action == 'reject':
             self.reject()
+        elif self.args.action == 'migrate':
+            self.migrate()
+        elif self.args.action == 'compact':
+            self.compact()
         else:
             logging.error('Please use a correct argument')
             exit(1)
 
     def approve(self):
-        if 'id' not in self.args:
-            logging.error('Please give an id')
+        self.set_approvals(True)
+
+    def reject(self):
+        self.set_approvals(False)
+
+    def targets(self):
+        """
+        Find the locks given by the arguments, with keyed or indexed reads only
+        :return: the list of (label, function returning the Lock or None)
+        """
+        if self.args.id:
+            return [(id, lambda id=id: self.storage.get_lock_by_id(id, pool=self.args.pool)) for id in self.args.id]
+        if not self.args.pool:
+            logging.error('Please give an id, or a pool with --lock, --team or --pipeline')
             exit(1)
-        approval_lock = self.engine.scan(Approval).filter(id=self.args.id).all()
-        if not approval_lock:
-            logging.info('No lock with the id %s has been found' % self.args.id)
+        if self.args.lock:
+            return [(lockname, lambda lockname=lockname: self.storage.get_lock(self.args.pool, lockname))
+                    for lockname in self.args.lock]
+        # The locks of the pool waiting for an approval
+        filters = dict((key, getattr(self.args, key)) for key in ('team', 'pipeline') if getattr(self.args, key))
+        approval_locks = list(self.storage.query_pool(self.args.pool, claimed=True, need_approval=True,
+                                                      approved=None, **filters))
+        return [(approval_lock.id, lambda approval_lock=approval_lock: approval_lock)
+                for approval_lock in approval_locks]
+
+    def set_approvals(self, approved):
+        verb = 'approved' if approved else 'rejected'
+        targets = self.targets()
+        if not targets:
+            logging.info('No lock matches the selection')
             exit(1)
-        approval_lock = approval_lock[0]
-        approval_lock.approved = True
-        approval_lock.timestamp = datetime.utcnow()
-        self.engine.save(approval_lock, overwrite=True)
-        logging.info('The lock %s has been approved' % self.args.id)
 
-    def reject(self):
-        if 'id' not in self.args:
-            logging.error('Please give an id')
+        def set_approval(target):
+            label, read = target
+            try:
+                approval_lock = read()
+                if approval_lock:
+                    # The lock that was just read is written as is, it is only read again on a conflict
+                    approval_lock = self.storage.update_lock(
+                        approval_lock.pool, approval_lock.lockname,
+                        lambda approval_lock: self.set_approved(approval_lock, approved), current=approval_lock)
+                if not approval_lock:
+                    return None, 'No lock %s has been found' % label
+                return approval_lock, 'The lock %s has been %s' % (label, verb)
+            except Exception as error:
+                return None, 'The lock %s could not be %s: %s' % (label, verb, error)
+
+        # The writes are conditional, so they are sent concurrently rather than in a batch
+        failures = 0
+        # The most recent timestamp of the updated locks of each pool
+        pools = {}
+        with ThreadPoolExecutor(max_workers=self.args.workers) as executor:
+            for approval_lock, message in executor.map(set_approval, targets):
+                if approval_lock:
+                    logging.info(message)
+                    if approval_lock.pool not in pools or pools[approval_lock.pool] < approval_lock.timestamp:
+                        pools[approval_lock.pool] = approval_lock.timestamp
+                else:
+                    failures += 1
+                    logging.error(message)
+        # Let the checks of the pools see the new versions
+        for pool, modified in pools.items():
+            self.storage.touch_pool(pool, modified)
+        if failures:
+            logging.error('%d of %d lock(s) have not been %s' % (failures, len(targets), verb))
             exit(1)
-        approval_lock = self.engine.scan(Approval).filter(id=self.args.id).all()
+
+    def set_approved(self, approval_lock, approved):
         if not approval_lock:
-            logging.info('No lock with the id %s has been found' % self.args.id)
-            exit(1)
-        approval_lock = approval_lock[0]
-        approval_lock.approved = False
+            return None
+        approval_lock.approved = approved
         approval_lock.timestamp = datetime.utcnow()
-        self.engine.save(approval_lock, overwrite=True)
-        logging.info('The lock %s has been rejected' % self.args.id)
+        return approval_lock
+
+    def migrate(self):
+        # Move the locks created with a random id to their deterministic id.
+        # The most recent item of a lock is migrated first, older duplicates are then dropped.
+        # The indexes missing on tables created by older versions are added too.
+        count = self.storage.migrate()
+        logging.info('%d lock(s) have been migrated' % count)
 
+    def compact(self):
+        # Move the locks of a pool released for a while to an archive table or file, and delete them from the pool
+        if not self.args.pool:
+            logging.error('Please give the pool to compact')
+            exit(1)
+        if self.args.archive_file:
+            archive = FileArchive(self.args.archive_file)
+        else:
+            archive = TableArchive(self.storage, self.args.archive_table)
+        before = datetime.now() - timedelta(seconds=self.args.older_than)
+        count = compact(self.storage, self.args.pool, before, archive, limit=self.args.limit)
+        logging.info('%d lock(s) released before %s have been moved to %s' % (count, before, archive))
 
     def list(self):
-        approval_locks = self.engine.scan(Approval).filter(claimed=True).all()
-        table = []
+        filters = dict((key, getattr(self.args, key)) for key in ('team', 'pipeline') if getattr(self.args, key))
+        for key in ('claimed', 'need_approval', 'approved'):
+            if getattr(self.args, key) != 'any':
+                filters[key] = FILTER_VALUES[getattr(self.args, key)]
 
-        if approval_locks:
-            headers = sorted(approval_locks[0].keys_())
+        if self.args.pool:
+            approval_locks = self.storage.query_pool(self.args.pool, **filters)
         else:
-            headers = None
-        if approval_locks:
-            for item in approval_locks:
-                row = []
-                for key in sorted(item.keys_()):
-                    row.append(getattr(item, key))
-                table.append(row)
-
-            print(tabulate(table, headers))
+            approval_locks = self.parallel_scan(filters)
+
+        if self.args.format == 'json':
+            count = self.print_json(approval_locks)
         else:
+            count = self.print_table(approval_locks)
+        if not count and self.args.format != 'json':
             print('There is no waiting approval')
 
+    def parallel_scan(self, filters):
+        """
+        Scan the table in segments read in parallel.
+        The locks are yielded as soon as a segment reads them, and the segments wait while too many locks are
+        not consumed yet, so the memory used does not depend on the size of the table.
+        """
+        results = queue.Queue(maxsize=self.args.page_size)
+
+        def scan(segment):
+            try:
+                for approval_lock in self.storage.scan_locks(segment=segment, total_segments=self.args.segments,
+                                                             **filters):
+                    results.put(approval_lock)
+            except Exception as error:
+                results.put(error)
+            results.put(None)
+
+        for segment in range(self.args.segments):
+            threading.Thread(target=scan, args=(segment,), daemon=True).start()
+        remaining = self.args.segments
+        while remaining:
+            result = results.get()
+            if result is None:
+                remaining -= 1
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                yield result
+
+    def print_json(self, approval_locks):
+        """ Print a JSON object per lock, as soon as it is read """
+        count = 0
+        for approval_lock in approval_locks:
+            print(json.dumps(approval_lock.to_dict(), default=str, sort_keys=True), flush=True)
+            count += 1
+        return count
+
+    def print_table(self, approval_locks):
+        """ Print the locks in tables of page_size rows, as soon as a page is read """
+        headers = sorted(Lock.FIELDS)
+        count = 0
+        table = []
+        for approval_lock in approval_locks:
+            table.append([getattr(approval_lock, key) for key in headers])
+            count += 1
+            if len(table) == self.args.page_size:
+                print(tabulate(table, headers), flush=True)
+                table = []
+        if table:
+            print(tabulate(table, headers), flush=True)
+        return count
+
 # Standard boilerplate to call the main() function to begin
 # the program.
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(description="Approval CLI")
   parser.add_argument('action', type=str)
-  parser.add_argument("--id")
+  parser.add_argument("--id", action='append', help="id of a lock, can be given several times")
+  parser.add_argument("--pool", help="pool of the locks")
+  parser.add_argument("--lock", action='append', help="name of a lock of the pool, can be given several times")
+  parser.add_argument("--team", help="only the locks of this team")
+  parser.add_argument("--pipeline", help="only the locks of this pipeline")
+  parser.add_argument("--workers", type=int, default=8, help="number of concurrent updates")
+  parser.add_argument("--claimed", choices=['true', 'false', 'any'], default='true',
+                      help="list the claimed locks, the released ones or both")
+  parser.add_argument("--need-approval", choices=['true', 'false', 'any'], default='any')
+  parser.add_argument("--approved", choices=['true', 'false', 'none', 'any'], default='any',
+                      help="none lists the locks waiting for an approval")
+  parser.add_argument("--segments", type=int, default=4, help="number of segments of the table scanned in parallel")
+  parser.add_argument("--page-size", type=int, default=100, help="number of rows of the tables printed by list")
+  parser.add_argument("--format", choices=['table', 'json'], default='table',
+                      help="json prints a JSON object per line")
+  parser.add_argument("--older-than", type=float, default=30 * 24 * 3600,
+                      help="compact the locks released more than this number of seconds ago, 30 days by default")
+  parser.add_argument("--archive-table", default=ARCHIVE_TABLE, help="table of the compacted locks")
+  parser.add_argument("--archive-file", help="local file to append the compacted locks to, instead of a table")
+  parser.add_argument("--limit", type=int, help="maximum number of locks to compact")
+  parser.add_argument("--backend", default='dynamodb', help="storage backend: dynamodb or sqlite")
+  parser.add_argument("--database", default=':memory:', help="database file of the sqlite backend")
+  parser.add_argument("--region", default='eu-west-1', help="AWS region of the dynamodb backend")
 
   parser.add_argument(
                       "-v",
@@ -0,0 +1,103 @@
+"""
+    Run the resource commands against a SQLite database, like Concourse runs them: each command is a new process
+    reading its payload on stdin, with the BUILD_* variables of its build in the environment.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+# The resource is next to the tests in the repository, in /opt/resource in the image
+ASSETS_DIR = os.environ.get('RESOURCE_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                         'assets'))
+sys.path.insert(0, ASSETS_DIR)
+
+from sqlite_storage import SQLiteStorage  # noqa: E402
+
+POOL = 'test-pool'
+
+# Maximum time a command is expected to take, in seconds
+TIMEOUT = 30
+
+
+class ResourceTestCase(unittest.TestCase):
+    """
+        A pool in a SQLite database of a temporary directory, polled every fraction of a second
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='approval-test')
+        self.database = os.path.join(self.work_dir, 'approval.db')
+        self.storage = SQLiteStorage(self.database)
+        self.processes = []
+
+    def tearDown(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            process.stdout.close()
+            process.stderr.close()
+        self.storage.connection.close()
+        shutil.rmtree(self.work_dir)
+
+    def source(self, **options):
+        return dict({'pool': POOL, 'backend': 'sqlite', 'database': self.database, 'wait_lock': 0.5,
+                     'wait_lock_min': 0.1}, **options)
+
+    def start(self, command, build, params, source=None, version=None):
+        """
+        Start a resource command in a new process
+        :param command: check, in or out
+        :param build: the BUILD_ID of the build running the command
+        :return: the Popen of the command
+        """
+        payload = {'source': source or self.source(), 'params': params}
+        if version is not None:
+            payload['version'] = version
+        args = [sys.executable, os.path.join(ASSETS_DIR, command)]
+        if command != 'check':
+            args.append(tempfile.mkdtemp(dir=self.work_dir))
+        env = dict(os.environ, BUILD_ID=build, BUILD_PIPELINE_NAME='pipeline-%s' % build, BUILD_TEAM_NAME='main')
+        process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   env=env, universal_newlines=True)
+        process.stdin.write(json.dumps(payload))
+        process.stdin.close()
+        self.processes.append(process)
+        return process
+
+    def finish(self, process, status=0):
+        """
+        Wait for the end of a command and check its exit status. Its log is kept in the errors attribute.
+        :return: the JSON output of the command, None if it failed
+        """
+        process.wait(timeout=TIMEOUT)
+        output = process.stdout.read()
+        process.errors = process.stderr.read()
+        self.assertEqual(process.returncode, status, process.errors)
+        return json.loads(output) if output else None
+
+    def run_command(self, command, build, params, source=None, status=0):
+        """ Run a resource command until its end """
+        return self.finish(self.start(command, build, params, source=source), status=status)
+
+    def lock(self, lockname):
+        return self.storage.get_lock(POOL, lockname)
+
+    def wait_until(self, condition, message):
+        """ Wait until a condition on the storage is met """
+        deadline = time.time() + TIMEOUT
+        while not condition():
+            if time.time() > deadline:
+                self.fail(message)
+            time.sleep(0.05)
+
+
+def metadata(output):
+    """ The metadata of the output of in or out, as a dict """
+    return dict((entry['name'], entry['value']) for entry in output['metadata'])
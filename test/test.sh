@@ -0,0 +1,12 @@
+#!/bin/bash
+
+set -eu -o pipefail
+
+test_dir="$( cd "$( dirname "$0" )" && pwd )"
+
+# In the image, the tests are next to the resource installed in /opt/resource
+if [ ! -d "${test_dir}/../assets" ]; then
+  export RESOURCE_DIR="${RESOURCE_DIR:-/opt/resource}"
+fi
+
+python3 -m unittest discover --start-directory "${test_dir}" --pattern 'test_*.py' "$@"
@@ -0,0 +1,80 @@
+"""
+    Waits delegated to the node-local agent
+"""
+
+import json
+import os
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+import unittest
+
+from fixtures import ASSETS_DIR, POOL, ResourceTestCase
+from agent import Agent, AgentRequestHandler, connect, is_loopback
+from sqlite_storage import SQLiteStorage
+
+
+class TestAgent(ResourceTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.address = os.path.join(self.work_dir, 'agent.sock')
+        self.server = socketserver.ThreadingUnixStreamServer(self.address, AgentRequestHandler)
+        self.server.daemon_threads = True
+        self.server.agent = Agent(SQLiteStorage(self.database), interval=0.1)
+        threading.Thread(target=self.server.agent.run, daemon=True).start()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server.agent.storage.connection.close()
+        super().tearDown()
+
+    def request(self, request):
+        with connect(self.address, timeout=10) as connection:
+            connection.sendall((json.dumps(request) + '\n').encode())
+            return json.loads(connection.makefile().readline())
+
+    def test_agent_wakes_up_the_waiting_get(self):
+        # Without the agent, the get would only read its lock again after a minute
+        source = self.source(agent=self.address, agent_fallback=60, wait_lock=60)
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'claim', 'need_approval': True},
+                         source=source)
+        get = self.start('in', 'build-1', {'lock_name': 'lock', 'need_approval': True}, source=source)
+        self.wait_until(lambda: 'waiting for an approval' in get.stderr.readline(), 'The get is not waiting')
+        start = time.time()
+        self.storage.update_lock(POOL, 'lock', lambda approval_lock: setattr(
+            approval_lock, 'approved', True) or approval_lock)
+        self.finish(get)
+        self.assertLess(time.time() - start, 10)
+
+    def test_wait_times_out_without_change(self):
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'claim'})
+        revision = self.lock('lock').revision
+        response = self.request({'pool': POOL, 'lockname': 'lock', 'revision': revision, 'timeout': 0.5})
+        self.assertEqual(response, {'changed': False})
+        response = self.request({'pool': POOL, 'lockname': 'lock', 'revision': revision - 1, 'timeout': 5})
+        self.assertEqual(response, {'changed': True})
+
+    def test_request_with_a_source_is_refused(self):
+        response = self.request({'source': {'backend': 'sqlite', 'database': '/tmp/other.db'}, 'pool': POOL,
+                                 'lockname': 'lock', 'revision': None, 'timeout': 1})
+        self.assertIn('source', response['error'])
+
+    def test_tcp_listener_is_only_on_the_loopback(self):
+        self.assertTrue(is_loopback('127.0.0.1'))
+        self.assertTrue(is_loopback('localhost'))
+        self.assertFalse(is_loopback('0.0.0.0'))
+        process = subprocess.run([sys.executable, os.path.join(ASSETS_DIR, 'agent.py'), '--listen', '0.0.0.0:0',
+                                  '--backend', 'sqlite', '--database', self.database],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                                 timeout=30)
+        self.assertEqual(process.returncode, 2)
+        self.assertIn('loopback', process.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+    Wait loops woken up by the change feed of the storage
+"""
+
+import time
+import unittest
+
+from fixtures import POOL, ResourceTestCase
+from changefeed import FeedWaiter
+from storage import lock_id
+
+
+class FailingFeed:
+
+    def wait(self, pool, lockname, timeout):
+        raise OSError('The stream is gone')
+
+
+class TestChangeFeed(ResourceTestCase):
+
+    def update(self, lockname, **fields):
+        """ Change fields of a lock """
+        def update(approval_lock):
+            for key, value in fields.items():
+                setattr(approval_lock, key, value)
+            return approval_lock
+        self.storage.update_lock(POOL, lockname, update)
+
+    def test_feed_starts_at_the_end_of_the_stream(self):
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'claim'})
+        feed = self.storage.change_feed()
+        feed.refresh_shards()
+        self.assertEqual(feed.records(), [])
+        self.update('lock', claimed=False, holder=None)
+        records = feed.records()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['event'], 'MODIFY')
+        self.assertEqual(records[0]['keys'], {'pool': POOL, 'id': lock_id(POOL, 'lock')})
+        self.assertEqual((records[0]['old']['claimed'], records[0]['new']['claimed']), (True, False))
+        self.assertEqual(records[0]['old']['holder'], 'build-1')
+        self.assertEqual(feed.records(), [])
+
+    def test_wait_only_wakes_up_on_the_watched_fields_of_the_lock(self):
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'claim'})
+        self.run_command('out', 'build-1', {'lock_name': 'other', 'action': 'claim'})
+        feed = self.storage.change_feed()
+        feed.refresh_shards()
+        self.update('other', approved=True)
+        self.update('lock', description='Not watched')
+        self.assertFalse(feed.wait(POOL, 'lock', 0.3))
+        self.update('lock', approved=True)
+        start = time.time()
+        self.assertTrue(feed.wait(POOL, 'lock', 10))
+        self.assertLess(time.time() - start, 1)
+
+    def test_feed_wakes_up_the_waiting_get(self):
+        # Without the feed, the get would only read its lock again after a minute
+        source = self.source(change_feed=True, change_feed_fallback=60)
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'claim', 'need_approval': True},
+                         source=source)
+        get = self.start('in', 'build-1', {'lock_name': 'lock', 'need_approval': True}, source=source)
+        self.wait_until(lambda: 'waiting for an approval' in get.stderr.readline(), 'The get is not waiting')
+        start = time.time()
+        self.update('lock', approved=True)
+        self.finish(get)
+        self.assertLess(time.time() - start, 10)
+
+    def test_failed_feed_falls_back_to_polling(self):
+        waiter = FeedWaiter(FailingFeed(), 'pool', 'lock', fallback=0.2)
+        start = time.time()
+        waiter(60)
+        self.assertLess(time.time() - start, 1)
+        self.assertIsNone(waiter.feed)
+
+    def test_get_times_out_between_the_changes(self):
+        source = self.source(change_feed=True, change_feed_fallback=60)
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'claim', 'need_approval': True},
+                         source=source)
+        start = time.time()
+        # A timeout of 1.2 seconds
+        self.run_command('in', 'build-1', {'lock_name': 'lock', 'need_approval': True, 'timeout': 0.02},
+                         source=source, status=1)
+        self.assertLess(time.time() - start, 10)
+        self.assertFalse(self.lock('lock').claimed)
+
+
+if __name__ == '__main__':
+    unittest.main()
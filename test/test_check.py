@@ -0,0 +1,73 @@
+"""
+    Versions returned by check, from the locks of the pool changed after the current version
+"""
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+import json
+import os
+import unittest
+
+from fixtures import POOL, ResourceTestCase
+from storage import Lock, lock_id
+
+
+class TestCheck(ResourceTestCase):
+
+    def save(self, lockname, age):
+        """ Save a lock changed age seconds ago """
+        approval_lock = Lock(id=lock_id(POOL, lockname), lockname=lockname, pool=POOL, claimed=False,
+                             timestamp=datetime.now() - timedelta(seconds=age))
+        self.storage.save_lock(approval_lock)
+        self.storage.touch_pool(POOL, approval_lock.timestamp)
+        return approval_lock
+
+    def check(self, version=None, **options):
+        return self.finish(self.start('check', 'build-check', {}, source=self.source(**options), version=version))
+
+    def version(self, approval_lock):
+        return {'timestamp': str(Decimal(approval_lock.timestamp.timestamp()))}
+
+    def test_versions_are_the_locks_changed_after_the_version(self):
+        first, second, third = self.save('first', 30), self.save('second', 20), self.save('third', 10)
+        self.assertEqual(self.check(), [self.version(first), self.version(second), self.version(third)])
+        self.assertEqual(self.check(self.version(first)), [self.version(second), self.version(third)])
+
+    def test_check_limit_continues_from_the_last_version(self):
+        locks = [self.save('lock-%d' % index, 50 - index) for index in range(5)]
+        versions = self.check(check_limit=2)
+        self.assertEqual(versions, [self.version(approval_lock) for approval_lock in locks[:2]])
+        versions = self.check(versions[-1], check_limit=2)
+        self.assertEqual(versions, [self.version(approval_lock) for approval_lock in locks[2:4]])
+
+    def test_no_change_returns_the_current_version(self):
+        approval_lock = self.save('lock', 10)
+        self.assertEqual(self.check(self.version(approval_lock)), [self.version(approval_lock)])
+
+    def checked_methods(self, version):
+        """ The storage methods called by a check, from its statistics """
+        sink = os.path.join(self.work_dir, 'stats.jsonl')
+        if os.path.exists(sink):
+            os.unlink(sink)
+        self.check(version, stats=sink)
+        with open(sink) as stats:
+            return sorted(json.loads(stats.readline())['methods'])
+
+    def test_check_skips_the_query_when_the_marker_did_not_move(self):
+        approval_lock = self.save('lock', 20)
+        self.assertEqual(self.checked_methods(self.version(approval_lock)), ['get_pool_marker'])
+        self.save('other', 10)
+        self.assertEqual(self.checked_methods(self.version(approval_lock)), ['get_pool_marker', 'query_since'])
+
+    def test_every_write_moves_the_marker(self):
+        revisions = []
+        for action in ('claim', 'release'):
+            self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': action})
+            marker = self.storage.get_pool_marker(POOL)
+            self.assertEqual(marker.modified, self.lock('lock').timestamp)
+            revisions.append(marker.revision)
+        self.assertLess(revisions[0], revisions[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+    Claims of a lock by contending builds
+"""
+
+import time
+import unittest
+
+from fixtures import POOL, ResourceTestCase, metadata
+
+
+class TestClaims(ResourceTestCase):
+
+    def test_contending_claims_are_exclusive(self):
+        builds = ['build-%s' % index for index in range(5)]
+        claims = dict((build, self.start('out', build, {'lock_name': 'shared', 'action': 'claim'}))
+                      for build in builds)
+        acquired = []
+        while len(acquired) < len(builds):
+            self.wait_until(lambda: len([process for process in claims.values() if process.poll() is not None]) >
+                            len(acquired), 'No claim acquired the lock')
+            time.sleep(1)
+            finished = [build for build, process in claims.items() if process.poll() is not None]
+            self.assertEqual(len(finished), len(acquired) + 1, 'Several builds hold the lock')
+            holder = [build for build in finished if build not in acquired][0]
+            output = self.finish(claims[holder])
+            self.assertEqual(self.lock('shared').holder, holder)
+            self.assertEqual(metadata(output)['holder'], holder)
+            acquired.append(holder)
+            self.run_command('out', holder, {'lock_name': 'shared', 'action': 'release'})
+        self.assertEqual(sorted(acquired), builds)
+        self.assertFalse(self.lock('shared').claimed)
+
+    def test_metadata_values_are_strings(self):
+        output = self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'claim', 'lease': 60})
+        for entry in output['metadata']:
+            self.assertTrue(entry['value'] is None or isinstance(entry['value'], str), entry)
+        self.assertEqual(metadata(output)['revision'], str(self.lock('lock').revision))
+
+    def test_revision_grows_with_each_write(self):
+        revisions = []
+        for action in ('claim', 'release', 'claim'):
+            output = self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': action})
+            revisions.append(int(metadata(output)['revision']))
+        self.assertEqual(revisions, sorted(set(revisions)))
+
+    def test_approved_get_succeeds(self):
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'claim', 'need_approval': True})
+        get = self.start('in', 'build-1', {'lock_name': 'lock', 'need_approval': True})
+        self.storage.update_lock(POOL, 'lock', lambda approval_lock: setattr(
+            approval_lock, 'approved', True) or approval_lock)
+        output = self.finish(get)
+        self.assertEqual(metadata(output)['approved'], 'True')
+
+    def test_rejected_get_hands_the_lock_over_to_the_queue(self):
+        source = self.source(queue=True)
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'claim', 'need_approval': True},
+                         source=source)
+        get = self.start('in', 'build-1', {'lock_name': 'lock', 'need_approval': True}, source=source)
+        claim = self.start('out', 'build-2', {'lock_name': 'lock', 'action': 'claim'}, source=source)
+        self.wait_until(lambda: self.lock('lock').queue, 'The claim is not queued')
+        rejected_lock = self.storage.update_lock(POOL, 'lock', lambda approval_lock: setattr(
+            approval_lock, 'approved', False) or approval_lock)
+        self.finish(get, status=1)
+        approval_lock = self.lock('lock')
+        self.assertEqual(approval_lock.holder, 'build-2')
+        self.assertGreaterEqual(approval_lock.rejection_ack, rejected_lock.revision)
+        self.finish(claim)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""
+    Approval, rejection and listing of the locks from the command line
+"""
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from fixtures import ASSETS_DIR, POOL, TIMEOUT, ResourceTestCase
+
+# The CLI is next to the resource in the repository, it is not installed in the image
+CLI = os.path.join(os.path.dirname(ASSETS_DIR), 'cli.py')
+
+
+@unittest.skipUnless(os.path.exists(CLI), 'The CLI is not next to the resource')
+class TestCLI(ResourceTestCase):
+
+    def cli(self, action, *args, status=0):
+        """ Run the CLI against the database of the test and check its exit status """
+        process = subprocess.run([sys.executable, CLI, action, '--backend', 'sqlite', '--database', self.database] +
+                                 list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 universal_newlines=True, timeout=TIMEOUT)
+        self.assertEqual(process.returncode, status, process.stderr)
+        return process
+
+    def claim(self, build, lockname, need_approval=True):
+        self.run_command('out', build, {'lock_name': lockname, 'action': 'claim', 'need_approval': need_approval})
+
+    def test_approve_the_given_locks(self):
+        self.claim('build-1', 'first')
+        self.claim('build-1', 'second')
+        self.claim('build-1', 'third')
+        marker = self.storage.get_pool_marker(POOL)
+        self.cli('approve', '--pool', POOL, '--lock', 'first', '--lock', 'third')
+        self.assertEqual([self.lock(lockname).approved for lockname in ('first', 'second', 'third')],
+                         [True, None, True])
+        # The next check sees the approvals
+        self.assertGreater(self.storage.get_pool_marker(POOL).revision, marker.revision)
+
+    def test_approve_by_id(self):
+        self.claim('build-1', 'lock')
+        self.cli('approve', '--id', self.lock('lock').id)
+        self.assertTrue(self.lock('lock').approved)
+
+    def test_reject_the_pending_approvals_of_a_pipeline(self):
+        self.claim('build-1', 'first')
+        self.claim('build-2', 'second')
+        self.claim('build-2', 'released')
+        self.run_command('out', 'build-2', {'lock_name': 'released', 'action': 'release'})
+        self.claim('build-2', 'without-approval', need_approval=False)
+        self.cli('reject', '--pool', POOL, '--pipeline', 'pipeline-build-2')
+        self.assertIsNone(self.lock('first').approved)
+        self.assertIs(self.lock('second').approved, False)
+        self.assertIsNone(self.lock('released').approved)
+        self.assertIsNone(self.lock('without-approval').approved)
+
+    def test_missing_lock_fails(self):
+        self.claim('build-1', 'lock')
+        process = self.cli('approve', '--pool', POOL, '--lock', 'lock', '--lock', 'missing', status=1)
+        self.assertIn('No lock missing has been found', process.stderr)
+        self.assertTrue(self.lock('lock').approved)
+
+    def list_json(self, *args):
+        output = self.cli('list', '--format', 'json', *args).stdout
+        return sorted(json.loads(line)['lockname'] for line in output.splitlines())
+
+    def test_list_filters_the_locks_of_a_pool(self):
+        self.claim('build-1', 'first')
+        self.claim('build-2', 'second', need_approval=False)
+        self.claim('build-2', 'released')
+        self.run_command('out', 'build-2', {'lock_name': 'released', 'action': 'release'})
+        self.cli('approve', '--pool', POOL, '--lock', 'first')
+        # Only the claimed locks by default
+        self.assertEqual(self.list_json('--pool', POOL), ['first', 'second'])
+        self.assertEqual(self.list_json('--pool', POOL, '--claimed', 'any'), ['first', 'released', 'second'])
+        self.assertEqual(self.list_json('--pool', POOL, '--approved', 'true'), ['first'])
+        self.assertEqual(self.list_json('--pool', POOL, '--pipeline', 'pipeline-build-2', '--need-approval',
+                                        'false'), ['second'])
+
+    def test_list_scans_all_the_pools_in_segments(self):
+        for index in range(10):
+            self.claim('build-1', 'lock-%d' % index)
+        self.run_command('out', 'build-1', {'lock_name': 'other', 'action': 'claim'},
+                         source=self.source(pool='other-pool'))
+        locknames = self.list_json('--segments', '3')
+        self.assertEqual(locknames, sorted(['lock-%d' % index for index in range(10)] + ['other']))
+
+    def test_list_prints_tables(self):
+        for index in range(3):
+            self.claim('build-1', 'lock-%d' % index)
+        output = self.cli('list', '--pool', POOL, '--page-size', '2').stdout
+        for index in range(3):
+            self.assertIn('lock-%d' % index, output)
+        self.assertNotIn('There is no waiting approval', output)
+        self.assertIn('There is no waiting approval', self.cli('list', '--pool', 'empty-pool').stdout)
+
+
+if __name__ == '__main__':
+    unittest.main()
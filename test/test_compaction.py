@@ -0,0 +1,91 @@
+"""
+    Compaction of the released locks of a pool
+"""
+
+from datetime import datetime, timedelta
+import json
+import os
+import time
+import unittest
+
+from fixtures import POOL, ResourceTestCase
+from compaction import FileArchive, TableArchive, compact
+from storage import ARCHIVE_TABLE, Lock, lock_id
+
+
+class TestCompaction(ResourceTestCase):
+
+    def save(self, lockname, age, **fields):
+        """ Save a lock changed age seconds ago """
+        fields = dict({'claimed': False}, **fields)
+        approval_lock = Lock(id=lock_id(POOL, lockname), lockname=lockname, pool=POOL,
+                             timestamp=datetime.now() - timedelta(seconds=age), **fields)
+        self.storage.save_lock(approval_lock)
+        return approval_lock
+
+    def locknames(self):
+        return sorted(approval_lock.lockname for approval_lock in self.storage.query_pool(POOL))
+
+    def test_only_old_released_locks_are_compacted(self):
+        for index in range(60):
+            self.save('old-%02d' % index, 3600)
+        self.save('claimed', 3600, claimed=True, holder='build-1')
+        self.save('queued', 3600, queue=[{'holder': 'build-2', 'expires': int(time.time()) + 60}])
+        self.save('fresh', 10)
+        count = compact(self.storage, POOL, datetime.now() - timedelta(seconds=60),
+                        TableArchive(self.storage, ARCHIVE_TABLE))
+        self.assertEqual(count, 60)
+        self.assertEqual(self.locknames(), ['claimed', 'fresh', 'queued'])
+        archived = self.storage.connection.execute('SELECT COUNT(*) FROM "%s"' % ARCHIVE_TABLE).fetchone()[0]
+        self.assertEqual(archived, 60)
+
+    def test_limit_and_file_archive(self):
+        for index in range(30):
+            self.save('old-%02d' % index, 3600 - index)
+        path = os.path.join(self.work_dir, 'archive.jsonl')
+        count = compact(self.storage, POOL, datetime.now() - timedelta(seconds=60), FileArchive(path), limit=10)
+        self.assertEqual(count, 10)
+        with open(path) as archive:
+            archived = [json.loads(line)['lockname'] for line in archive]
+        # The oldest locks go first
+        self.assertEqual(archived, ['old-%02d' % index for index in range(10)])
+        self.assertEqual(len(self.locknames()), 20)
+
+    def test_lock_changed_during_the_compaction_is_kept(self):
+        self.save('lock', 3600)
+
+        class ClaimingArchive(FileArchive):
+            # A build claims the lock between its archival and its deletion
+            def save(archive, locks):
+                super().save(locks)
+                self.storage.update_lock(POOL, 'lock', lambda approval_lock: setattr(
+                    approval_lock, 'claimed', True) or approval_lock)
+
+        count = compact(self.storage, POOL, datetime.now() - timedelta(seconds=60),
+                        ClaimingArchive(os.path.join(self.work_dir, 'archive.jsonl')))
+        self.assertEqual(count, 0)
+        self.assertTrue(self.lock('lock').claimed)
+
+    def test_revision_continues_after_the_compaction(self):
+        approval_lock = self.save('lock', 3600)
+        for _ in range(4):
+            approval_lock = self.storage.update_lock(POOL, 'lock', lambda approval_lock: approval_lock)
+        self.assertEqual(approval_lock.revision, 5)
+        compact(self.storage, POOL, datetime.now(), FileArchive(os.path.join(self.work_dir, 'archive.jsonl')))
+        self.assertIsNone(self.lock('lock'))
+        output = self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'claim'})
+        self.assertEqual(self.lock('lock').revision, 6)
+        self.assertIn({'name': 'revision', 'value': '6'}, output['metadata'])
+
+    def test_release_compacts_the_pool(self):
+        for index in range(30):
+            self.save('old-%02d' % index, 3600)
+        source = self.source(compact_after=60)
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'claim'}, source=source)
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'release'}, source=source)
+        # A release compacts a batch of the pool at most
+        self.assertEqual(len(self.locknames()), 30 - 25 + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+"""
+    Leases of the claims, extended by heartbeats, and time to live of the released locks
+"""
+
+import time
+import unittest
+
+from fixtures import ResourceTestCase
+
+
+class TestLeases(ResourceTestCase):
+
+    def test_expired_lease_is_taken_over(self):
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'claim', 'lease': 1})
+        start = time.time()
+        self.run_command('out', 'build-2', {'lock_name': 'lock', 'action': 'claim', 'lease': 60})
+        self.assertGreater(time.time() - start, 0.5)
+        self.assertEqual(self.lock('lock').holder, 'build-2')
+        # The build which lost its lease can't extend it anymore
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'heartbeat', 'lease': 60}, status=1)
+        self.assertEqual(self.lock('lock').holder, 'build-2')
+
+    def test_heartbeat_keeps_the_lease(self):
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'claim', 'lease': 2})
+        claim = self.start('out', 'build-2', {'lock_name': 'lock', 'action': 'claim'})
+        for _ in range(3):
+            time.sleep(1)
+            self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'heartbeat', 'lease': 2})
+        self.assertIsNone(claim.poll())
+        self.assertEqual(self.lock('lock').holder, 'build-1')
+
+    def test_history_ttl_sets_the_expiry_of_the_leases_and_releases(self):
+        source = self.source(history_ttl=3600)
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'claim'}, source=source)
+        # A lock claimed without a lease is never deleted
+        self.assertIsNone(self.lock('lock').expires)
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'release'}, source=source)
+        self.assertAlmostEqual(self.lock('lock').expires, time.time() + 3600, delta=10)
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'claim', 'lease': 60}, source=source)
+        approval_lock = self.lock('lock')
+        self.assertEqual(approval_lock.expires, int(approval_lock.lease_expires.timestamp()) + 3600)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+"""
+    Debug log kept in memory and masking of the secrets of the source
+"""
+
+import io
+import logging
+import unittest
+
+from fixtures import ResourceTestCase
+from logbuffer import MASK, Redactor, RingBufferHandler, redact
+
+SECRET = 'wJalrXUtnFEMI/K7MDENG'
+
+
+class TestRedaction(unittest.TestCase):
+
+    def test_redact_masks_the_secret_fields(self):
+        data = {'source': {'pool': 'pool', 'AWS_ACCESS_KEY_ID': 'AKIA', 'AWS_SECRET_ACCESS_KEY': SECRET,
+                           'AWS_SESSION_TOKEN': ''}, 'params': {'lock_name': 'lock'}}
+        self.assertEqual(redact(data), {
+            'source': {'pool': 'pool', 'AWS_ACCESS_KEY_ID': MASK, 'AWS_SECRET_ACCESS_KEY': MASK,
+                       'AWS_SESSION_TOKEN': ''},
+            'params': {'lock_name': 'lock'},
+        })
+        # The data itself is left as is
+        self.assertEqual(data['source']['AWS_SECRET_ACCESS_KEY'], SECRET)
+
+    def test_redactor_masks_the_secrets_in_the_messages(self):
+        record = logging.LogRecord('test', logging.DEBUG, __file__, 1, 'environment: %s', ({'key': SECRET},), None)
+        self.assertTrue(Redactor([SECRET, None, '']).filter(record))
+        self.assertEqual(record.getMessage(), "environment: {'key': '%s'}" % MASK)
+
+    def test_ring_buffer_keeps_the_last_debug_records(self):
+        stream = io.StringIO()
+        target = logging.StreamHandler(stream)
+        target.setLevel(logging.INFO)
+        buffer = RingBufferHandler(target, capacity=3)
+        for index in range(5):
+            buffer.handle(logging.LogRecord('test', logging.DEBUG, __file__, 1, 'debug %d', (index,), None))
+        buffer.handle(logging.LogRecord('test', logging.INFO, __file__, 1, 'info', None, None))
+        self.assertEqual(stream.getvalue(), '')
+        buffer.dump()
+        self.assertEqual(stream.getvalue(), 'Debug log of the failed command:\ndebug 2\ndebug 3\ndebug 4\n')
+        buffer.dump()
+        self.assertEqual(stream.getvalue().count('debug'), 3)
+
+
+class TestCommandLog(ResourceTestCase):
+
+    def test_failed_command_dumps_its_debug_log_without_the_secrets(self):
+        source = self.source(AWS_SECRET_ACCESS_KEY=SECRET)
+        claim = self.start('out', 'build-1', {'lock_name': 'lock', 'action': 'claim'}, source=source)
+        self.finish(claim)
+        self.assertNotIn('Debug log of the failed command', claim.errors)
+        release = self.start('out', 'build-1', {'lock_name': 'missing', 'action': 'release'}, source=source)
+        self.finish(release, status=1)
+        self.assertIn('Debug log of the failed command', release.errors)
+        self.assertIn(MASK, release.errors)
+        self.assertNotIn(SECRET, release.errors)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+"""
+    Claims and releases of several locks at once
+"""
+
+import time
+import unittest
+
+from fixtures import ResourceTestCase, metadata
+
+
+class TestSeveralLocks(ResourceTestCase):
+
+    def test_claim_is_all_or_nothing(self):
+        self.run_command('out', 'build-1', {'lock_name': 'x', 'action': 'claim'})
+        claim = self.start('out', 'build-2', {'lock_names': ['x', 'y'], 'action': 'claim'})
+        time.sleep(1.5)
+        # The free lock is not claimed while the other one is held
+        self.assertIsNone(claim.poll())
+        self.assertIsNone(self.lock('y'))
+        self.run_command('out', 'build-1', {'lock_name': 'x', 'action': 'release'})
+        output = self.finish(claim)
+        for lockname in ('x', 'y'):
+            approval_lock = self.lock(lockname)
+            self.assertTrue(approval_lock.claimed)
+            self.assertEqual(approval_lock.holder, 'build-2')
+            self.assertEqual(metadata(output)[lockname + '.revision'], str(approval_lock.revision))
+
+    def test_overlapping_claims_are_exclusive(self):
+        first = self.start('out', 'build-1', {'lock_names': ['x', 'y'], 'action': 'claim'})
+        second = self.start('out', 'build-2', {'lock_names': ['y', 'z'], 'action': 'claim'})
+        self.wait_until(lambda: first.poll() is not None or second.poll() is not None, 'No claim acquired the locks')
+        time.sleep(1)
+        winner, loser = (first, second) if first.poll() is not None else (second, first)
+        self.assertIsNone(loser.poll())
+        self.finish(winner)
+        holder = self.lock('y').holder
+        locknames = ['x', 'y'] if holder == 'build-1' else ['y', 'z']
+        self.run_command('out', holder, {'lock_names': locknames, 'action': 'release'})
+        self.finish(loser)
+        self.assertNotEqual(self.lock('y').holder, holder)
+
+    def test_release_is_all_or_nothing(self):
+        self.run_command('out', 'build-1', {'lock_names': ['x', 'y'], 'action': 'claim'})
+        self.run_command('out', 'build-1', {'lock_names': ['x', 'missing'], 'action': 'release'}, status=1)
+        self.assertTrue(self.lock('x').claimed)
+        self.run_command('out', 'build-1', {'lock_names': ['x', 'y'], 'action': 'release'})
+        self.assertFalse(self.lock('x').claimed)
+        self.assertFalse(self.lock('y').claimed)
+
+
+if __name__ == '__main__':
+    unittest.main()
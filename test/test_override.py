@@ -0,0 +1,54 @@
+"""
+    Override of the pending approval of a lock by a new claim
+"""
+
+import time
+import unittest
+
+from fixtures import ResourceTestCase
+
+
+class TestOverride(ResourceTestCase):
+
+    def override(self, build, timeout):
+        return self.start('out', build, {'lock_name': 'lock', 'action': 'claim', 'override_approval': True,
+                                         'override_timeout': timeout})
+
+    def test_override_waits_for_the_rejection_acknowledgement(self):
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'claim', 'need_approval': True})
+        get = self.start('in', 'build-1', {'lock_name': 'lock', 'need_approval': True})
+        self.wait_until(lambda: 'waiting for an approval' in get.stderr.readline(), 'The get is not waiting')
+        override = self.override('build-2', 20)
+        self.finish(get, status=1)
+        self.finish(override)
+        self.assertIn('The rejection of the previous approval has been acknowledged', override.errors)
+        approval_lock = self.lock('lock')
+        self.assertEqual(approval_lock.holder, 'build-2')
+        self.assertTrue(approval_lock.claimed)
+        self.assertIsNotNone(approval_lock.rejection_ack)
+
+    def test_override_without_a_get_gives_up_after_its_timeout(self):
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'claim', 'need_approval': True})
+        start = time.time()
+        override = self.override('build-2', 1)
+        # Nothing releases the rejected lock, the override waits for it like any claim
+        self.wait_until(lambda: "hasn't been acknowledged after 1 seconds" in override.stderr.readline(),
+                        'The override did not give up')
+        self.assertLess(time.time() - start, 10)
+        self.assertIsNone(override.poll())
+        self.assertFalse(self.lock('lock').approved)
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'release'})
+        self.finish(override)
+        self.assertEqual(self.lock('lock').holder, 'build-2')
+
+    def test_override_of_a_released_lock_does_not_wait(self):
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'claim', 'need_approval': True})
+        self.run_command('out', 'build-1', {'lock_name': 'lock', 'action': 'release'})
+        start = time.time()
+        self.finish(self.override('build-2', 20))
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(self.lock('lock').holder, 'build-2')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+"""
+    Adaptive polling interval of the wait loops
+"""
+
+import unittest
+
+import fixtures  # noqa: F401
+from poller import Poller
+from storage import Throttled
+
+
+class TestPoller(unittest.TestCase):
+
+    def setUp(self):
+        self.sleeps = []
+        self.poller = Poller(min_interval=1, max_interval=8, jitter=0, sleep=self.sleeps.append)
+
+    def test_interval_doubles_up_to_the_maximum(self):
+        for _ in range(5):
+            self.poller.wait()
+        self.assertEqual(self.sleeps, [1, 2, 4, 8, 8])
+
+    def test_change_resets_the_interval(self):
+        self.assertTrue(self.poller.observe(1))
+        self.poller.wait()
+        self.poller.wait()
+        self.assertFalse(self.poller.observe(1))
+        self.poller.wait()
+        self.assertTrue(self.poller.observe(2))
+        self.poller.wait()
+        self.assertEqual(self.sleeps, [1, 2, 4, 1])
+
+    def test_wait_is_jittered_below_the_interval(self):
+        poller = Poller(min_interval=4, max_interval=4, jitter=0.5, sleep=self.sleeps.append)
+        for _ in range(100):
+            poller.wait()
+        self.assertTrue(all(2 <= delay <= 4 for delay in self.sleeps))
+        self.assertGreater(len(set(self.sleeps)), 1)
+
+    def test_limit_and_slowdown(self):
+        self.poller.wait(limit=0.5)
+        self.poller.wait(limit=-1)
+        self.poller.wait(slowdown=3)
+        self.assertEqual(self.sleeps, [0.5, 0, 12])
+
+    def test_throttled_poll_backs_off_and_tries_again(self):
+        reads = []
+
+        def read():
+            reads.append(len(self.sleeps))
+            if len(reads) < 3:
+                raise Throttled('Slow down')
+            return 'lock'
+
+        self.assertEqual(self.poller.poll(read), 'lock')
+        self.assertEqual(len(reads), 3)
+        self.assertEqual(self.sleeps, [8, 8])
+
+
+if __name__ == '__main__':
+    unittest.main()
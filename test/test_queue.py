@@ -0,0 +1,66 @@
+"""
+    Handover of a released lock to the builds waiting in its queue
+"""
+
+import unittest
+
+from fixtures import ResourceTestCase, metadata
+
+
+class TestQueue(ResourceTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.queue_source = self.source(queue=True)
+
+    def claim(self, build):
+        return self.start('out', build, {'lock_name': 'lock', 'action': 'claim'}, source=self.queue_source)
+
+    def release(self, build):
+        return self.run_command('out', build, {'lock_name': 'lock', 'action': 'release'}, source=self.queue_source)
+
+    def wait_queued(self, count):
+        self.wait_until(lambda: len(self.lock('lock').queue or []) == count, 'The builds are not queued')
+
+    def test_release_hands_over_to_the_queue_in_order(self):
+        self.finish(self.claim('build-1'))
+        claims = {}
+        for index, build in enumerate(('build-2', 'build-3', 'build-4')):
+            claims[build] = self.claim(build)
+            self.wait_queued(index + 1)
+        self.assertEqual([ticket['holder'] for ticket in self.lock('lock').queue], ['build-2', 'build-3', 'build-4'])
+
+        holder = 'build-1'
+        for position, build in enumerate(('build-2', 'build-3', 'build-4')):
+            self.release(holder)
+            # The release itself gives the lock to the first build of the queue
+            approval_lock = self.lock('lock')
+            self.assertTrue(approval_lock.claimed)
+            self.assertEqual(approval_lock.holder, build)
+            output = self.finish(claims[build])
+            self.assertEqual(metadata(output)['holder'], build)
+            self.assertEqual(metadata(output)['queue_position'], str(position))
+            holder = build
+
+        self.release(holder)
+        approval_lock = self.lock('lock')
+        self.assertFalse(approval_lock.claimed)
+        self.assertIsNone(approval_lock.queue)
+
+    def test_claim_behind_the_queue_waits_for_its_turn(self):
+        self.finish(self.claim('build-1'))
+        first = self.claim('build-2')
+        self.wait_queued(1)
+        self.release('build-1')
+        second = self.claim('build-3')
+        self.finish(first)
+        self.wait_queued(1)
+        # build-3 doesn't get the lock before build-2 releases it
+        self.assertIsNone(second.poll())
+        self.release('build-2')
+        self.finish(second)
+        self.assertEqual(self.lock('lock').holder, 'build-3')
+
+
+if __name__ == '__main__':
+    unittest.main()